@@ -0,0 +1,151 @@
+"""Blocking file system calls of the request path, run off the event loop.
+
+Segment reads, index refreshes, appends and metadata log reads run in a DiskExecutor :
+one per disk (file system device), with a pool of threads threads and at most max_queued
+calls admitted at once, queued or running. Further calls wait on the event loop : a slow
+disk holds back the requests touching it, not every connection of the loop, and the
+backlog of a disk stays bounded.
+
+LoopLagMonitor measures how late the event loop runs a sleep of interval_ms : the lag is
+how long the loop was kept from serving connections.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter_ns
+from typing import Callable
+
+from .metrics import LatencyHistogram
+
+IO_THREADS = 4  # per disk
+MAX_QUEUED = 64  # calls admitted per disk, queued in the pool or running
+LOOP_LAG_INTERVAL_MS = 100
+
+
+class DiskExecutor:
+    """Bounded thread pool of one disk"""
+
+    def __init__(self, device: int, threads: int = IO_THREADS, max_queued: int = MAX_QUEUED):
+        self.device = device
+        self.max_queued = max_queued
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"disk-io-{device:x}")
+        self.loop = None
+        self.slots = None  # asyncio.Semaphore of max_queued, for the running loop
+        self.waiting = 0  # calls waiting for a slot
+        self.admitted = 0  # calls queued in the pool or running
+        self.calls = 0
+        self.latency = LatencyHistogram()  # us, from the call to its result, waiting included
+
+    async def run(self, fn: Callable, *args):
+        """Result of fn(*args), called in the pool"""
+        start = perf_counter_ns()
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop, self.slots = loop, asyncio.Semaphore(self.max_queued)
+        slots = self.slots
+        self.waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        try:
+            return await loop.run_in_executor(self.pool, fn, *args)
+        finally:
+            self.admitted -= 1
+            slots.release()
+            self.calls += 1
+            self.latency.record((perf_counter_ns() - start) // 1000)
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False)
+
+
+class DiskExecutors:
+    """The DiskExecutor of each disk, found from the device of the directories accessed.
+
+    Devices are cached by directory. A directory that was not added is assumed to be on the
+    disk of its closest added parent (a new partition directory is on the disk of the logs
+    directory), so that only add_directory calls os.stat.
+    """
+
+    def __init__(self, threads: int = IO_THREADS, max_queued: int = MAX_QUEUED):
+        self.threads = threads
+        self.max_queued = max_queued
+        self.devices = {}  # directory -> device
+        self.executors = {}  # device -> DiskExecutor
+
+    def add_directory(self, directory: str) -> int:
+        """Cache the device of a directory, or of its closest existing parent (blocking)"""
+        directory = os.path.normpath(directory)
+        path = directory
+        while True:
+            try:
+                device = os.stat(path).st_dev
+                break
+            except FileNotFoundError:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    device = 0
+                    break
+                path = parent
+        self.devices[directory] = device
+        return device
+
+    def device(self, path: str) -> int:
+        directory = os.path.normpath(path)
+        while True:
+            device = self.devices.get(directory)
+            if device is not None:
+                return device
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return self.add_directory(path)
+            directory = parent
+
+    def executor(self, path: str) -> DiskExecutor:
+        """Executor of the disk holding path (a directory, or a file of a known directory)"""
+        device = self.device(path)
+        executor = self.executors.get(device)
+        if executor is None:
+            executor = self.executors[device] = DiskExecutor(device, self.threads, self.max_queued)
+        return executor
+
+    async def run(self, path: str, fn: Callable, *args):
+        """Result of fn(*args), called in the executor of the disk holding path"""
+        return await self.executor(path).run(fn, *args)
+
+    def waiting(self) -> int:
+        return sum(executor.waiting for executor in self.executors.values())
+
+    def admitted(self) -> int:
+        return sum(executor.admitted for executor in self.executors.values())
+
+    def calls(self) -> int:
+        return sum(executor.calls for executor in self.executors.values())
+
+    def shutdown(self) -> None:
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors.clear()
+
+
+class LoopLagMonitor:
+    """Background task recording how late the event loop wakes up from a sleep of interval_ms"""
+
+    def __init__(self, interval_ms: int = LOOP_LAG_INTERVAL_MS):
+        self.interval_ms = interval_ms
+        self.lag = LatencyHistogram()  # us
+        self.last = 0  # us, lag of the last wake up
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        interval = self.interval_ms / 1000
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.last = max(int((loop.time() - expected) * 1e6), 0)
+            self.lag.record(self.last)
+
+
+disk_executors = DiskExecutors()
@@ -0,0 +1,134 @@
+"""Response encoding : Kafka wire types packed into a single growing buffer."""
+import struct
+
+from .storage import FileRegion
+from .varint import MSB_SET_MASK, encode_unsigned_varint
+
+INT8 = struct.Struct(">b")
+UINT8 = struct.Struct(">B")
+INT16 = struct.Struct(">h")
+UINT16 = struct.Struct(">H")
+INT32 = struct.Struct(">i")
+UINT32 = struct.Struct(">I")
+INT64 = struct.Struct(">q")
+UINT64 = struct.Struct(">Q")
+UUID = struct.Struct(">16s")
+
+
+class ResponseWriter:
+    """Typed writer of a response frame.
+
+    Fields are packed with precompiled struct.Struct objects straight into one bytearray,
+    grown by doubling. The first 4 bytes are reserved for the message size, filled in by
+    finish(). FileRegions and buffer regions are not copied : they split the frame into
+    the parts returned by finish().
+    """
+
+    __slots__ = ("buffer", "position", "regions", "no_response", "errors")
+
+    def __init__(self, capacity: int = 256):
+        self.buffer = bytearray(max(capacity, UINT32.size))
+        self.position = UINT32.size  # message size
+        self.regions = []  # (buffer position, FileRegion)
+        self.no_response = False  # set by handlers of requests that get no response (acks=0)
+        self.errors = None  # error code -> count, for the metrics
+
+    def error(self, code: int) -> None:
+        """Count an error code written in the response, for the metrics"""
+        if code:
+            if self.errors is None:
+                self.errors = {}
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def reserve(self, size: int) -> None:
+        needed = self.position + size
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(max(needed, 2 * len(self.buffer)) - len(self.buffer)))
+
+    def pack(self, compiled: struct.Struct, *values) -> None:
+        self.reserve(compiled.size)
+        compiled.pack_into(self.buffer, self.position, *values)
+        self.position += compiled.size
+
+    def int8(self, value: int) -> None:
+        self.pack(INT8, value)
+
+    def uint8(self, value: int) -> None:
+        self.pack(UINT8, value)
+
+    def int16(self, value: int) -> None:
+        self.pack(INT16, value)
+
+    def uint16(self, value: int) -> None:
+        self.pack(UINT16, value)
+
+    def int32(self, value: int) -> None:
+        self.pack(INT32, value)
+
+    def uint32(self, value: int) -> None:
+        self.pack(UINT32, value)
+
+    def int64(self, value: int) -> None:
+        self.pack(INT64, value)
+
+    def uint64(self, value: int) -> None:
+        self.pack(UINT64, value)
+
+    def uuid(self, value: bytes) -> None:
+        self.pack(UUID, value)
+
+    def raw(self, data) -> None:
+        size = len(data)
+        self.reserve(size)
+        self.buffer[self.position : self.position + size] = data
+        self.position += size
+
+    def unsigned_varint(self, value: int) -> None:
+        if value < MSB_SET_MASK:
+            self.pack(UINT8, value)
+        else:
+            self.raw(encode_unsigned_varint(value))
+
+    def compact_string(self, value: bytes | None) -> None:
+        """COMPACT_(NULLABLE_)STRING : length + 1 as an unsigned varint, 0 for null"""
+        if value is None:
+            self.pack(UINT8, 0)
+        else:
+            self.unsigned_varint(len(value) + 1)
+            self.raw(value)
+
+    def compact_array_length(self, length: int | None) -> None:
+        """COMPACT_(NULLABLE_)ARRAY length : length + 1 as an unsigned varint, 0 for null"""
+        self.unsigned_varint(0 if length is None else length + 1)
+
+    def tagged_fields(self) -> None:
+        """Empty tagged fields section"""
+        self.pack(UINT8, 0)
+
+    def file_region(self, region: FileRegion) -> None:
+        """Bytes streamed from a file at this point of the frame"""
+        self.regions.append((self.position, region))
+
+    def buffer_region(self, view: memoryview) -> None:
+        """Bytes sent from an existing buffer at this point of the frame, without copying them"""
+        self.regions.append((self.position, view))
+
+    def __len__(self) -> int:
+        return self.position - UINT32.size + sum(len(region) for _, region in self.regions)
+
+    def finish(self) -> list:
+        """Fill in the message size and return the frame.
+
+        Returns:
+            list: memoryviews and FileRegions, to send in order
+        """
+        UINT32.pack_into(self.buffer, 0, len(self))
+        view = memoryview(self.buffer)
+        parts = []
+        start = 0
+        for position, region in self.regions:
+            parts.append(view[start:position])
+            parts.append(region)
+            start = position
+        parts.append(view[start : self.position])
+        return parts
@@ -0,0 +1,122 @@
+"""Incremental fetch sessions (KIP-227).
+
+A consumer opening a session (session id 0, epoch 0) sends its full partition list once;
+the broker caches the partitions with their fetch position and what was last answered
+for them. Later requests of the session carry the next epoch and only the partitions
+that changed (and the ones to forget), and the responses only carry the partitions with
+new records, an error, or a moved high watermark or log start offset.
+"""
+import random
+from collections import OrderedDict
+
+INVALID_SESSION_ID = 0
+INITIAL_EPOCH = 0  # full request opening a new session (closing the given one if any)
+FINAL_EPOCH = -1  # full request without session (closing the given one if any)
+INT32_MAX = 2**31 - 1
+MAX_CACHE_SLOTS = 1000
+
+
+def next_epoch(epoch: int) -> int:
+    return 1 if epoch >= INT32_MAX else epoch + 1
+
+
+class FetchSessionIdNotFound(LookupError):
+    pass
+
+
+class InvalidFetchSessionEpoch(ValueError):
+    pass
+
+
+class CachedPartition:
+    """Fetch position of a partition of a session and the state last answered for it"""
+
+    __slots__ = ("fetch_offset", "partition_max_bytes", "high_watermark", "log_start_offset")
+
+    def __init__(self, fetch_offset: int, partition_max_bytes: int):
+        self.fetch_offset = fetch_offset
+        self.partition_max_bytes = partition_max_bytes
+        self.high_watermark = -1
+        self.log_start_offset = -1
+
+
+class FetchSession:
+    __slots__ = ("id", "epoch", "partitions")
+
+    def __init__(self, session_id: int):
+        self.id = session_id
+        self.epoch = 1  # epoch expected from the next request
+        self.partitions = {}  # (topic id, partition index) -> CachedPartition, in fetch order
+
+    def update(self, requested: dict, forgotten: list) -> None:
+        """Apply the partitions listed by a request of the session.
+
+        Args:
+            requested (dict): (topic id, partition index) -> (fetch offset, partition max bytes)
+            forgotten (list): (topic id, partition index) to remove from the session
+        """
+        for key, (fetch_offset, partition_max_bytes) in requested.items():
+            cached = self.partitions.get(key)
+            if cached is None:
+                self.partitions[key] = CachedPartition(fetch_offset, partition_max_bytes)
+            else:
+                cached.fetch_offset = fetch_offset
+                cached.partition_max_bytes = partition_max_bytes
+        for key in forgotten:
+            self.partitions.pop(key, None)
+
+    def changed(self, key: tuple, high_watermark: int, log_start_offset: int, has_records: bool, error_code: int) -> bool:
+        """Record the state answered for a partition.
+
+        Returns:
+            bool: whether the partition belongs in an incremental response
+        """
+        cached = self.partitions[key]
+        moved = cached.high_watermark != high_watermark or cached.log_start_offset != log_start_offset
+        cached.high_watermark = high_watermark
+        cached.log_start_offset = log_start_offset
+        return moved or has_records or error_code != 0
+
+
+class FetchSessionCache:
+    """Sessions by id, evicting the least recently used one when max_slots are taken"""
+
+    def __init__(self, max_slots: int = MAX_CACHE_SLOTS):
+        self.max_slots = max_slots
+        self.sessions = OrderedDict()  # session id -> FetchSession, least recently used first
+        self.evicted = 0
+
+    def new_session(self) -> FetchSession | None:
+        """Open a session, or return None when sessions are disabled (max_slots = 0)"""
+        if self.max_slots <= 0:
+            return None
+        while len(self.sessions) >= self.max_slots:
+            self.sessions.popitem(last=False)
+            self.evicted += 1
+        session_id = random.randint(1, INT32_MAX)
+        while session_id in self.sessions:
+            session_id = random.randint(1, INT32_MAX)
+        session = self.sessions[session_id] = FetchSession(session_id)
+        return session
+
+    def get(self, session_id: int, epoch: int) -> FetchSession:
+        """Session of an incremental request, whose epoch must be the one expected next.
+
+        Raises:
+            FetchSessionIdNotFound: unknown or evicted session
+            InvalidFetchSessionEpoch: request epoch out of sequence
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise FetchSessionIdNotFound(session_id)
+        if session.epoch != epoch:
+            raise InvalidFetchSessionEpoch(f"session {session_id} expects epoch {session.epoch}, got {epoch}")
+        self.sessions.move_to_end(session_id)
+        session.epoch = next_epoch(epoch)
+        return session
+
+    def remove(self, session_id: int) -> None:
+        self.sessions.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
@@ -1,119 +1,428 @@
+"""Streaming parser of the KRaft __cluster_metadata log.
+
+MetadataLogParser walks the complete record batches of a buffer with a ByteParser,
+decoding the fields in place, and yields a typed record (FeatureLevel, Topic, Partition,
+RemoveTopic) per metadata record it knows. Nothing is copied out of the buffer but the
+topic and feature names; records of other types, control batches and compressed batches
+are skipped.
+
+PartitionTable holds the partitions in int32 columns rather than an object per partition,
+and Metadata indexes a whole log with it.
+"""
 import uuid
-from collections import defaultdict
+from array import array
+from itertools import chain
+from struct import Struct
+
 from .parser import ByteParser
+from .storage import BATCH_HEADER, BATCH_LENGTH_END, BATCH_RECORDS_START, MAGIC_V2
 
-BASE_UUID = uuid.UUID("00000000-0000-0000-0000-000000000000")
+RECORDS_COUNT_START = BATCH_RECORDS_START - 4
+COMPRESSION_MASK = 0x07
+CONTROL_FLAG = 0x20
+# leader, leader epoch, partition epoch
+PARTITION_LEADER = Struct(">iii")
 
-class Metadata:
-    def __init__(self, file):
-        self.parser = ByteParser(file)
+FEATURE_LEVEL_RECORD = 12
+TOPIC_RECORD = 2
+PARTITION_RECORD = 3
+REMOVE_TOPIC_RECORD = 9
+
+
+class FeatureLevel:
+    __slots__ = ("offset", "name", "level")
+
+    def __init__(self, offset: int, name: bytes, level: int):
+        self.offset = offset
+        self.name = name
+        self.level = level
+
+
+class Topic:
+    __slots__ = ("offset", "name", "topic_id")
+
+    def __init__(self, offset: int, name: bytes, topic_id: int):
+        self.offset = offset
+        self.name = name
+        self.topic_id = topic_id  # UUID as an int
+
+
+class Partition:
+    __slots__ = (
+        "offset",
+        "partition_id",
+        "topic_id",
+        "replicas",
+        "isr",
+        "removing_replicas",
+        "adding_replicas",
+        "leader",
+        "leader_epoch",
+        "partition_epoch",
+    )
+
+    def __init__(self, offset, partition_id, topic_id, replicas, isr, removing_replicas, adding_replicas, leader, leader_epoch, partition_epoch):
+        self.offset = offset
+        self.partition_id = partition_id
+        self.topic_id = topic_id
+        self.replicas = replicas  # tuples of broker ids
+        self.isr = isr
+        self.removing_replicas = removing_replicas
+        self.adding_replicas = adding_replicas
+        self.leader = leader
+        self.leader_epoch = leader_epoch
+        self.partition_epoch = partition_epoch
+
+
+class RemoveTopic:
+    __slots__ = ("offset", "topic_id")
+
+    def __init__(self, offset: int, topic_id: int):
+        self.offset = offset
+        self.topic_id = topic_id
+
+
+def parse_feature_level(parser: ByteParser, offset: int) -> FeatureLevel:
+    name = parser.compact_string()
+    return FeatureLevel(offset, name, parser.int16())
+
+
+def parse_topic(parser: ByteParser, offset: int) -> Topic:
+    name = parser.compact_string()
+    return Topic(offset, name, parser.uuid_int())
+
+
+def parse_partition(parser: ByteParser, offset: int) -> Partition:
+    # the directories and the tagged fields following the partition epoch are not used
+    return Partition(
+        offset,
+        parser.int32(),  # partition id
+        parser.uuid_int(),  # topic id
+        parser.int32_array(),  # replicas
+        parser.int32_array(),  # in sync replicas
+        parser.int32_array(),  # removing replicas
+        parser.int32_array(),  # adding replicas
+        *parser.unpack(PARTITION_LEADER),
+    )
+
+
+def parse_remove_topic(parser: ByteParser, offset: int) -> RemoveTopic:
+    return RemoveTopic(offset, parser.uuid_int())
+
+
+# record type -> parser of the value fields following the frame version, type and version
+VALUE_PARSERS = {
+    FEATURE_LEVEL_RECORD: parse_feature_level,
+    TOPIC_RECORD: parse_topic,
+    PARTITION_RECORD: parse_partition,
+    REMOVE_TOPIC_RECORD: parse_remove_topic,
+}
+
+
+class MetadataLogParser:
+    """Iterate over the metadata records of the complete batches of a buffer.
+
+    A partial batch at the end of the buffer (still being written) is left for the next
+    parse : position stops right before it.
+
+    Args:
+        buffer: bytes-like content of the log, from a batch boundary
+        position (int, optional): buffer position of the first batch to parse. Defaults to 0.
+    """
+
+    def __init__(self, buffer, position: int = 0):
+        self.parser = ByteParser(buffer, position)
+        self.position = position  # end of the last fully parsed batch
+        self.last_offset = -1  # offset of the last record of the last fully parsed batch
+        self.last_batch_position = -1  # start of the last fully parsed batch
         self.batches = 0
-        self.topics = defaultdict(lambda: {"uuid": BASE_UUID, "partitions": []})
-        self.partitions = {}
-        self.parse_log_file()
-        for id in self.partitions.keys():
-            topic_uuids = self.partitions[id]["topics"]
-            for uuid in topic_uuids:
-                for topic in self.topics:
-                    if uuid == self.topics[topic]["uuid"]:
-                        self.topics[topic]["partitions"].append(id)
-
-    def parse_log_file(self):
-        batches = self.separate_batches()
-        for batch in batches:
-            self.parse_batch(batch)
-
-    def separate_batches(self):
+
+    def __iter__(self):
         parser = self.parser
-        batches = []
-        while not parser.finished:
-            offset = parser.consume(8)
-            print(f"offset {int.from_bytes(offset)}")
+        view = parser.view
+        end = len(view)
+        parser.index = position = self.position
+        while position + BATCH_RECORDS_START <= end:
+            base_offset, batch_length, _epoch, magic, _crc, attributes, last_offset_delta = (
+                BATCH_HEADER.unpack_from(view, position)
+            )
+            batch_end = position + BATCH_LENGTH_END + batch_length
+            if batch_end > end:
+                break
+            if magic == MAGIC_V2 and not attributes & (COMPRESSION_MASK | CONTROL_FLAG):
+                parser.index = position + RECORDS_COUNT_START
+                for _ in range(parser.int32()):
+                    length = parser.varint()
+                    record_end = parser.index + length
+                    record = self.parse_record(parser, base_offset)
+                    if record is not None:
+                        yield record
+                    parser.index = record_end
+            self.last_batch_position = position
+            parser.index = position = self.position = batch_end
+            self.last_offset = base_offset + last_offset_delta
             self.batches += 1
-            batch_length = int.from_bytes(parser.consume(4))
-            batches.append(parser.consume(batch_length))
-        return batches
-
-    def parse_batch(self, batch):
-        parser = ByteParser(batch)
-        ple = parser.consume(4)
-        mb = parser.consume(1)
-        crc = parser.consume(4)
-        type = parser.consume(2)
-        offset = parser.consume(4)
-        length = int.from_bytes(offset) + 1
-        created_at = parser.consume(8)
-        updated_at = parser.consume(8)
-        p_id = parser.consume(8)
-        p_epoch = parser.consume(2)
-        base_sequence = parser.consume(4)
-        record_count = parser.consume(4)
-        records = self.separate_records(parser)
-        for record in records:
-            self.parse_record(record)
-
-    def separate_records(self, parser):
-        records = []
-        while not parser.eof():
-            length = parser.consume_var_int()
-            record = parser.consume(length)
-            records.append(record)
-        return records
-
-    def parse_record(self, batch):
-        parser = ByteParser(batch)
-        attribute = parser.consume(1)
-        timestamp_delta = parser.consume_var_int()
-        offset_delta = parser.consume_var_int()
-        key_length = parser.consume_var_int()
-        if key_length != -1:
-            parser.read(1)
-        value_length = parser.consume_var_int()
-        value = parser.consume(value_length)
-        self.parse_value(value)
-
-    def parse_value(self, value):
-        parser = ByteParser(value)
-        frame_version = parser.consume(1)
-        type = int.from_bytes(parser.consume(1))
-        match type:
-            case 2:
-                self.parse_topic(parser)
-            case 3:
-                self.parse_partition(parser)
-
-    def parse_topic(self, parser):
-        version = parser.consume(1)
-        length_of_name = parser.consume_var_int(False) - 1
-        topic_name = parser.consume(length_of_name)
-        raw_uuid = parser.consume(16)
-        self.topics[topic_name] = {"uuid": uuid.UUID(bytes=raw_uuid), "partitions": []}
-
-    def parse_partition(self, parser):
-        version = parser.consume(1)
-        partition_id = parser.consume(4)
-        raw_uuid = parser.consume(16)
-        length_of_replica_array = parser.consume_var_int(False) - 1
-        replicas = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
-        in_sync = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
-        removing = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
-        adding = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
-        leader = parser.consume(4)
-        epoch = parser.consume(4)
-        partition_epoch = parser.consume(4)
-        directories = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
-        if partition_id in self.partitions:
-            self.partitions[partition_id]["topics"].append(uuid.UUID(bytes=raw_uuid))
+
+    @staticmethod
+    def parse_record(parser: ByteParser, base_offset: int):
+        """Typed record of the value of the record at the parser position, None for other record types"""
+        parser.index += 1  # attributes
+        parser.varlong()  # timestamp delta
+        offset_delta = parser.varint()
+        key_length = parser.varint()
+        if key_length > 0:
+            parser.index += key_length
+        if parser.varint() < 3:  # value length
+            return None
+        # frame version, type and version are varints, all below 128 in practice
+        value_parser = VALUE_PARSERS.get(parser.view[parser.index + 1])
+        if value_parser is None:
+            return None
+        parser.index += 3
+        return value_parser(parser, base_offset + offset_delta)
+
+
+class PartitionTable:
+    """Columnar state of the partitions of a cluster.
+
+    A partition is a row of int32 columns (array module) : its topic index, partition id,
+    leader, leader epoch and partition epoch, and where its replicas and in sync replicas
+    are in the two flattened replicas and isr arrays. A million partitions of 3 replicas
+    take about 60 MB.
+
+    The rows of a topic are contiguous, so that the partitions of a topic are the rows
+    between its start and end, found in O(1) from the topic UUID. Rows are appended in log
+    order, which keeps them grouped while the partitions of a topic follow each other, as
+    when a topic is created. A partition added later to an older topic is appended out of
+    its range, and the rows are regrouped in one linear pass before the next lookup. The
+    same pass drops the rows of removed topics and the replicas no longer used.
+    """
+
+    # per topic index, then per row, then flattened ; every array has the "i" typecode
+    ARRAYS = (
+        "starts",
+        "ends",
+        "dense",
+        "topic",
+        "partition_id",
+        "leader",
+        "leader_epoch",
+        "partition_epoch",
+        "replicas_start",
+        "replicas_count",
+        "isr_start",
+        "isr_count",
+        "replicas",
+        "isr",
+    )
+
+    def __init__(self):
+        self.topic_indexes = {}  # topic UUID (int) -> topic index
+        self.topic_ids = []  # topic index -> topic UUID (int), None once removed
+        self.overflow = {}  # topic index -> rows of the topic appended out of its range
+        self.dead_rows = 0  # rows of removed topics
+        self.dead_entries = 0  # replicas and isr entries no longer used
+        self.starts = array("i")  # topic index -> first row of the topic
+        self.ends = array("i")  # topic index -> end of the rows of the topic
+        self.dense = array("i")  # topic index -> 1 when its rows are partitions 0..n-1 in order
+        self.topic = array("i")  # row -> topic index
+        self.partition_id = array("i")
+        self.leader = array("i")
+        self.leader_epoch = array("i")
+        self.partition_epoch = array("i")
+        self.replicas_start = array("i")
+        self.replicas_count = array("i")
+        self.isr_start = array("i")
+        self.isr_count = array("i")
+        self.replicas = array("i")
+        self.isr = array("i")
+
+    @classmethod
+    def from_arrays(cls, topic_ids: list, arrays: dict):
+        """Table of the topic UUIDs and ARRAYS of a compacted table"""
+        table = cls()
+        table.topic_ids = topic_ids
+        table.topic_indexes = {topic_id: topic for topic, topic_id in enumerate(topic_ids)}
+        for name in cls.ARRAYS:
+            setattr(table, name, arrays[name])
+        return table
+
+    def copy(self) -> "PartitionTable":
+        """Independent copy of the table : memory copies of its arrays, no work per partition"""
+        table = PartitionTable()
+        table.topic_indexes = self.topic_indexes.copy()
+        table.topic_ids = self.topic_ids.copy()
+        table.overflow = {topic: rows.copy() for topic, rows in self.overflow.items()}
+        table.dead_rows = self.dead_rows
+        table.dead_entries = self.dead_entries
+        for name in self.ARRAYS:
+            setattr(table, name, getattr(self, name)[:])
+        return table
+
+    def __len__(self) -> int:
+        return len(self.partition_id) - self.dead_rows
+
+    def nbytes(self) -> int:
+        """Memory used by the arrays"""
+        return sum(len(getattr(self, name)) * 4 for name in self.ARRAYS)
+
+    def add_topic(self, topic_id: int) -> int:
+        """Index of the topic, added without partitions if unknown"""
+        topic = self.topic_indexes.get(topic_id)
+        if topic is None:
+            topic = self.topic_indexes[topic_id] = len(self.topic_ids)
+            self.topic_ids.append(topic_id)
+            self.starts.append(len(self.partition_id))
+            self.ends.append(len(self.partition_id))
+            self.dense.append(1)
+        return topic
+
+    def remove_topic(self, topic_id: int) -> None:
+        topic = self.topic_indexes.pop(topic_id, None)
+        if topic is None:
+            return
+        rows = chain(range(self.starts[topic], self.ends[topic]), self.overflow.pop(topic, ()))
+        for row in rows:
+            self.dead_rows += 1
+            self.dead_entries += self.replicas_count[row] + self.isr_count[row]
+        self.topic_ids[topic] = None
+        self.ends[topic] = self.starts[topic]
+        if self.dead_rows > len(self):
+            self.compact()
+
+    def set_partition(self, record: Partition) -> None:
+        """Add the partition of a partition record, or update it"""
+        topic = self.add_topic(record.topic_id)
+        row = self.find_row(topic, record.partition_id)
+        if row is None:
+            self.append_row(topic, record)
+            return
+        self.leader[row] = record.leader
+        self.leader_epoch[row] = record.leader_epoch
+        self.partition_epoch[row] = record.partition_epoch
+        self.replicas_start[row] = self.store(self.replicas, self.replicas_start[row], self.replicas_count[row], record.replicas)
+        self.replicas_count[row] = len(record.replicas)
+        self.isr_start[row] = self.store(self.isr, self.isr_start[row], self.isr_count[row], record.isr)
+        self.isr_count[row] = len(record.isr)
+        if self.dead_entries > len(self.replicas) + len(self.isr) - self.dead_entries:
+            self.compact()
+
+    def append_row(self, topic: int, record: Partition) -> None:
+        row = len(self.partition_id)
+        start, end = self.starts[topic], self.ends[topic]
+        if start == end:
+            # no partition yet : the range of the topic moves to the end of the table
+            self.starts[topic] = start = end = row
+        if end == row:
+            if record.partition_id != end - start:
+                self.dense[topic] = 0
+            self.ends[topic] = row + 1
+        else:
+            self.overflow.setdefault(topic, []).append(row)
+        self.topic.append(topic)
+        self.partition_id.append(record.partition_id)
+        self.leader.append(record.leader)
+        self.leader_epoch.append(record.leader_epoch)
+        self.partition_epoch.append(record.partition_epoch)
+        self.replicas_start.append(len(self.replicas))
+        self.replicas_count.append(len(record.replicas))
+        self.replicas.extend(record.replicas)
+        self.isr_start.append(len(self.isr))
+        self.isr_count.append(len(record.isr))
+        self.isr.extend(record.isr)
+
+    def store(self, values: array, start: int, count: int, new: tuple) -> int:
+        """Start of the new entries of a row in a flattened array, replacing its count entries at start"""
+        if len(new) == count:
+            values[start : start + count] = array("i", new)
+            return start
+        self.dead_entries += count
+        start = len(values)
+        values.extend(new)
+        return start
+
+    def find_row(self, topic: int, partition_id: int) -> int | None:
+        start, end = self.starts[topic], self.ends[topic]
+        if self.dense[topic]:
+            row = start + partition_id if 0 <= partition_id < end - start else None
+            rows = self.overflow.get(topic, ())
         else:
-            self.partitions[partition_id] = {
-                "topics": [uuid.UUID(bytes=raw_uuid)],
-                "id": partition_id,
-                "leader": leader,
-                "leader_epoch": epoch,
-            }
-
-    def digest_array(self, parser, length, size_per_item):
-        ret = []
-        for _ in range(length):
-            ret.append(parser.consume(size_per_item))
-        return ret
\ No newline at end of file
+            row = None
+            rows = chain(range(start, end), self.overflow.get(topic, ()))
+        if row is None:
+            for candidate in rows:
+                if self.partition_id[candidate] == partition_id:
+                    return candidate
+        return row
+
+    def find(self, topic_id: int, partition_id: int) -> int | None:
+        """Row of a partition, None if unknown"""
+        topic = self.topic_indexes.get(topic_id)
+        return None if topic is None else self.find_row(topic, partition_id)
+
+    def topic_rows(self, topic_id: int) -> range:
+        """Rows of the partitions of a topic, empty if unknown"""
+        if self.overflow:
+            self.compact()
+        topic = self.topic_indexes.get(topic_id)
+        return range(self.starts[topic], self.ends[topic]) if topic is not None else range(0)
+
+    def compact(self) -> None:
+        """Regroup the rows by topic, in topic order, dropping removed topics and unused replicas"""
+        removed_topics = len(self.topic_ids) - len(self.topic_indexes)
+        if not (self.overflow or removed_topics or self.dead_entries):
+            return
+        order = []
+        topic_ids = []
+        starts, ends, dense, topics = array("i"), array("i"), array("i"), array("i")
+        for topic, topic_id in enumerate(self.topic_ids):
+            if topic_id is None:
+                continue
+            rows = range(self.starts[topic], self.ends[topic])
+            if topic in self.overflow:
+                rows = [*rows, *self.overflow[topic]]
+            new_topic = len(topic_ids)
+            topic_ids.append(topic_id)
+            starts.append(len(order))
+            order.extend(rows)
+            ends.append(len(order))
+            dense.append(all(self.partition_id[row] == i for i, row in enumerate(rows)))
+            topics.extend([new_topic] * len(rows))
+        arrays = {"starts": starts, "ends": ends, "dense": dense, "topic": topics}
+        for name in ("partition_id", "leader", "leader_epoch", "partition_epoch", "replicas_count", "isr_count"):
+            arrays[name] = array("i", map(getattr(self, name).__getitem__, order))
+        for name in ("replicas", "isr"):
+            values, row_starts, row_counts = getattr(self, name), getattr(self, name + "_start"), getattr(self, name + "_count")
+            new_values, new_starts = array("i"), array("i")
+            for row in order:
+                start = row_starts[row]
+                new_starts.append(len(new_values))
+                new_values.extend(values[start : start + row_counts[row]])
+            arrays[name], arrays[name + "_start"] = new_values, new_starts
+        compacted = PartitionTable.from_arrays(topic_ids, arrays)
+        self.__dict__.update(compacted.__dict__)
+
+
+class Metadata:
+    """Topics and partitions of a whole metadata log"""
+
+    def __init__(self, file):
+        self.topics = {}  # topic name -> topic UUID
+        self.partitions = PartitionTable()
+        self.features = {}
+        parser = MetadataLogParser(file)
+        for record in parser:
+            match record:
+                case Topic():
+                    self.topics[record.name] = uuid.UUID(int=record.topic_id)
+                    self.partitions.add_topic(record.topic_id)
+                case Partition():
+                    self.partitions.set_partition(record)
+                case FeatureLevel():
+                    self.features[record.name] = record.level
+        self.batches = parser.batches
+
+    def topic_partitions(self, name: bytes) -> range:
+        """Rows of self.partitions holding the partitions of a topic"""
+        topic_uuid = self.topics.get(name)
+        return self.partitions.topic_rows(topic_uuid.int) if topic_uuid is not None else range(0)
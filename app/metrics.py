@@ -0,0 +1,293 @@
+"""Request metrics : counters and latency histograms per API key and version, rendered in the
+Prometheus text format, served over HTTP and dumped periodically.
+
+Recording is kept to a few list index increments per request : the counters and the latency
+buckets of an API version are cells of one preallocated list, looked up once per request,
+and the bucket of a duration is read from a precomputed table. The counters and the total
+latency are recorded for every request, the decode, handler and send stages for one request
+in STAGE_SAMPLING only : the ones arriving while REQUESTS is a multiple of STAGE_SAMPLING,
+starting with the first one. The others do not even take the timestamps.
+"""
+import asyncio
+from math import ceil
+from typing import Callable
+
+SUB_BUCKET_BITS = 5  # significant bits of the recorded values : buckets are ~3% wide
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+MAX_SHIFT = 40  # values up to 2**45 us
+QUANTILES = (0.5, 0.99, 0.999)
+STAGES = ("decode", "handler", "send", "total")
+BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKET_HALF
+BUCKET_TABLE_SIZE = 1 << 16  # values below have their bucket in BUCKET_INDEX
+STAGE_SAMPLING = 16  # one request in STAGE_SAMPLING has its stages recorded, a power of two
+STAGE_SAMPLING_MASK = STAGE_SAMPLING - 1
+
+# cells of an API version : the counters, the sum of each stage, then the buckets of each stage
+COUNTERS = ("requests", "bytes_in", "bytes_out", "failures", "shed")
+REQUESTS, BYTES_IN, BYTES_OUT, FAILURES, SHED = range(len(COUNTERS))
+DECODE_SUM, HANDLER_SUM, SEND_SUM, TOTAL_SUM = range(len(COUNTERS), len(COUNTERS) + len(STAGES))
+DECODE, HANDLER, SEND, TOTAL = (len(COUNTERS) + len(STAGES) + stage * BUCKETS for stage in range(len(STAGES)))
+CELLS = len(COUNTERS) + len(STAGES) * (1 + BUCKETS)
+
+
+class LatencyHistogram:
+    """Log-linear histogram of durations in microseconds, as in HdrHistogram.
+
+    Values below 2**SUB_BUCKET_BITS have a bucket each; above, a bucket covers the values
+    sharing their SUB_BUCKET_BITS most significant bits, so that the relative error of the
+    quantiles is bounded by the bucket width whatever the range of the values.
+    """
+
+    __slots__ = ("counts", "total")
+
+    def __init__(self, counts: list[int] | None = None, total: int = 0):
+        self.counts = counts if counts is not None else [0] * BUCKETS
+        self.total = total
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        if shift <= MAX_SHIFT:
+            return shift * SUB_BUCKET_HALF + (value >> shift)
+        return BUCKETS - 1
+
+    def record(self, value: int) -> None:
+        self.counts[BUCKET_INDEX[value] if value < BUCKET_TABLE_SIZE else self.bucket_index(value)] += 1
+        self.total += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def max(self) -> int:
+        """Upper bound of the highest non empty bucket"""
+        for index in range(len(self.counts) - 1, -1, -1):
+            if self.counts[index]:
+                return self.bucket_upper_bound(index)
+        return 0
+
+    @staticmethod
+    def bucket_upper_bound(index: int) -> int:
+        if index < 2 * SUB_BUCKET_HALF:
+            return index
+        shift = index // SUB_BUCKET_HALF - 1
+        return ((index - shift * SUB_BUCKET_HALF + 1) << shift) - 1
+
+    def quantile(self, q: float) -> int:
+        """Upper bound of the bucket holding the q quantile, 0 when empty"""
+        count = self.count
+        if not count:
+            return 0
+        target = max(ceil(q * count), 1)
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return self.bucket_upper_bound(index)
+        return 0
+
+
+BUCKET_INDEX = bytes(LatencyHistogram.bucket_index(value) for value in range(BUCKET_TABLE_SIZE))
+
+
+def counter(cell: int) -> property:
+    return property(lambda stats: stats.cells[cell])
+
+
+def stage_histogram(sum_cell: int, first_bucket: int) -> property:
+    return property(
+        lambda stats: LatencyHistogram(stats.cells[first_bucket : first_bucket + BUCKETS], stats.cells[sum_cell])
+    )
+
+
+class ApiStats:
+    """Counters and latency histograms of one API key and version, in the cells list recorded
+    by the server (see record_handled and record_sent)"""
+
+    __slots__ = ("cells", "errors")
+
+    def __init__(self):
+        self.cells = [0] * CELLS
+        self.errors = {}  # error code -> responses carrying it
+
+    requests = counter(REQUESTS)
+    bytes_in = counter(BYTES_IN)
+    bytes_out = counter(BYTES_OUT)
+    failures = counter(FAILURES)  # requests whose handling raised, closing the connection
+    shed = counter(SHED)
+    decode = stage_histogram(DECODE_SUM, DECODE)  # request header parsing
+    handler = stage_histogram(HANDLER_SUM, HANDLER)  # body parsing and response encoding
+    send = stage_histogram(SEND_SUM, SEND)  # writing the response to the transport
+    total = stage_histogram(TOTAL_SUM, TOTAL)  # from the request read to the response sent
+
+    def note_errors(self, errors: dict) -> None:
+        for code, count in errors.items():
+            self.errors[code] = self.errors.get(code, 0) + count
+
+
+def record_handled(cells: list, started: int, decoded: int, handled: int) -> None:
+    """Record the decode and handler durations of a sampled request, from perf_counter_ns timestamps"""
+    us = (decoded - started) // 1000
+    cells[DECODE + (BUCKET_INDEX[us] if us < BUCKET_TABLE_SIZE else LatencyHistogram.bucket_index(us))] += 1
+    cells[DECODE_SUM] += us
+    us = (handled - decoded) // 1000
+    cells[HANDLER + (BUCKET_INDEX[us] if us < BUCKET_TABLE_SIZE else LatencyHistogram.bucket_index(us))] += 1
+    cells[HANDLER_SUM] += us
+
+
+def record_sent(cells: list, received: int, sending: int | None, sent: int, bytes_out: int | None) -> None:
+    """Record the total duration of a request and its response bytes (None for a request
+    without response), and its send duration when it is sampled (sending not None)"""
+    if bytes_out is not None:
+        if sending is not None:
+            us = (sent - sending) // 1000
+            cells[SEND + (BUCKET_INDEX[us] if us < BUCKET_TABLE_SIZE else LatencyHistogram.bucket_index(us))] += 1
+            cells[SEND_SUM] += us
+        cells[BYTES_OUT] += bytes_out
+    us = (sent - received) // 1000
+    cells[TOTAL + (BUCKET_INDEX[us] if us < BUCKET_TABLE_SIZE else LatencyHistogram.bucket_index(us))] += 1
+    cells[TOTAL_SUM] += us
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.apis = {}  # api key << 16 | api version -> ApiStats
+        self.gauges = []  # (name, type, help, value function), registered by other components
+        self.histograms = []  # (name, help, labels, LatencyHistogram in us), registered by other components
+
+    def api(self, api_key: int, api_version: int) -> ApiStats:
+        key = api_key << 16 | api_version
+        stats = self.apis.get(key)
+        if stats is None:
+            stats = self.apis[key] = ApiStats()
+        return stats
+
+    def sorted_apis(self) -> list[tuple[tuple[int, int], ApiStats]]:
+        return [((key >> 16, key & 0xFFFF), stats) for key, stats in sorted(self.apis.items())]
+
+    def register(self, name: str, kind: str, help_text: str, value: Callable[[], float]) -> None:
+        """Add a counter or a gauge maintained elsewhere, read at render time"""
+        self.gauges.append((name, kind, help_text, value))
+
+    def register_histogram(self, name: str, help_text: str, histogram: LatencyHistogram, labels: str = "") -> None:
+        """Add a histogram of durations maintained elsewhere, rendered as a summary in seconds.
+        Histograms registered under the same name, with different labels, form one family"""
+        self.histograms.append((name, help_text, labels, histogram))
+
+    def render(self, api_names: dict[int, str]) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        apis = self.sorted_apis()
+        labels = {
+            key: f'api="{api_names.get(key[0], "Unknown")}",api_key="{key[0]}",api_version="{key[1]}"'
+            for key, _ in apis
+        }
+        for attribute, name, help_text in (
+            ("requests", "kafka_requests_total", "Requests received"),
+            ("bytes_in", "kafka_request_bytes_total", "Bytes of the requests received"),
+            ("bytes_out", "kafka_response_bytes_total", "Bytes of the responses sent"),
+            ("failures", "kafka_request_failures_total", "Requests whose handling failed"),
+            ("shed", "kafka_requests_shed_total", "Requests answered with a throttled error because of load"),
+        ):
+            family(name, "counter", help_text)
+            for key, stats in apis:
+                lines.append(f"{name}{{{labels[key]}}} {getattr(stats, attribute)}")
+        family("kafka_response_errors_total", "counter", "Error codes in the responses sent")
+        for key, stats in apis:
+            for code, count in sorted(stats.errors.items()):
+                lines.append(f'kafka_response_errors_total{{{labels[key]},error_code="{code}"}} {count}')
+        family(
+            "kafka_request_latency_seconds",
+            "summary",
+            f"Request latency by stage, the stages other than total sampled 1 request in {STAGE_SAMPLING}",
+        )
+        for key, stats in apis:
+            for stage in STAGES:
+                histogram = getattr(stats, stage)
+                stage_labels = f'{labels[key]},stage="{stage}"'
+                count = histogram.count
+                for q in QUANTILES:
+                    lines.append(
+                        f'kafka_request_latency_seconds{{{stage_labels},quantile="{q}"}} {histogram.quantile(q) / 1e6}'
+                    )
+                lines.append(f"kafka_request_latency_seconds_sum{{{stage_labels}}} {histogram.total / 1e6}")
+                lines.append(f"kafka_request_latency_seconds_count{{{stage_labels}}} {count}")
+        for name, kind, help_text, value in self.gauges:
+            family(name, kind, help_text)
+            lines.append(f"{name} {value()}")
+        families = {}
+        for name, help_text, labels, histogram in self.histograms:
+            families.setdefault((name, help_text), []).append((labels, histogram))
+        for (name, help_text), histograms in families.items():
+            family(name, "summary", help_text)
+            for labels, histogram in histograms:
+                separator = "," if labels else ""
+                for q in QUANTILES:
+                    lines.append(f'{name}{{{labels}{separator}quantile="{q}"}} {histogram.quantile(q) / 1e6}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {histogram.total / 1e6}")
+                lines.append(f"{name}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, api_names: dict[int, str]) -> str:
+        """One line per API version : requests, errors and total latency quantiles in microseconds"""
+        lines = []
+        for (api_key, api_version), stats in self.sorted_apis():
+            total = stats.total
+            lines.append(
+                f"{api_names.get(api_key, api_key)} v{api_version} : {stats.requests} requests,"
+                f" {stats.bytes_in} B in, {stats.bytes_out} B out,"
+                f" {sum(stats.errors.values())} errors, {stats.shed} shed, {stats.failures} failed,"
+                f" latency us p50 {total.quantile(0.5)} p99 {total.quantile(0.99)}"
+                f" p999 {total.quantile(0.999)} max {total.max}"
+            )
+        for name, _help_text, labels, histogram in self.histograms:
+            if histogram.count:
+                lines.append(
+                    f"{name}{{{labels}}} us p50 {histogram.quantile(0.5)} p99 {histogram.quantile(0.99)}"
+                    f" p999 {histogram.quantile(0.999)} max {histogram.max}"
+                )
+        return "\n".join(lines)
+
+
+async def serve_metrics(host: str, port: int, render: Callable[[], str]) -> asyncio.Server:
+    """Minimal HTTP server answering GET /metrics with render(). The port is bound with
+    SO_REUSEPORT : a worker replaced by a graceful restart keeps serving its metrics until it
+    has drained, while its replacement already listens on the same port."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            target = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if target.split(b"?", 1)[0] == b"/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port, reuse_address=True, reuse_port=True)
+
+
+async def dump_periodically(interval_ms: int, summary: Callable[[], str]) -> None:
+    while True:
+        await asyncio.sleep(interval_ms / 1000)
+        text = summary()
+        if text:
+            print(text)
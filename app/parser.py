@@ -1,68 +1,196 @@
-MSB_SET_MASK = 0b10000000
-REMOVE_MSB_MASK = 0b01111111
+"""Cursor decoding the Kafka wire format and the record batch format in place.
+
+ByteParser reads typed fields at its position with struct.unpack_from over a memoryview of
+the data : consumed byte ranges are views of the data rather than copies, and varints are
+decoded straight from the buffer. Request bodies, request headers and the metadata log are
+all decoded with it.
+"""
+from functools import lru_cache
+from struct import Struct
+
+from .varint import MSB_SET_MASK, VARINT_MAX_BYTES, VARLONG_MAX_BYTES, decode_unsigned_varint
+
+INT8 = Struct(">b")
+INT16 = Struct(">h")
+INT32 = Struct(">i")
+INT64 = Struct(">q")
+UINT8 = Struct(">B")
+UINT16 = Struct(">H")
+UINT32 = Struct(">I")
+UUID_SIZE = 16
+
+
+
+@lru_cache(maxsize=64)
+def int32_array_struct(count: int) -> Struct:
+    """Struct of count int32, cached for the few counts the arrays actually have : the
+    count comes from the client, so the cache is bounded"""
+    return Struct(f">{count}i")
+
 
 class ByteParser:
-    def __init__(self, data: bytes):
+    """Read position over bytes-like data.
+
+    Typed readers raise struct.error, and the byte range readers ValueError, when the data
+    ends before the field.
+    """
+
+    __slots__ = ("data", "view", "index")
+
+    def __init__(self, data, index: int = 0):
         self.data = data
-        self.index = 0  # Current position in the byte stream
-        self.finished = False
+        self.view = data if isinstance(data, memoryview) else memoryview(data)
+        self.index = index  # Current position in the byte stream
+
+    @property
+    def finished(self) -> bool:
+        return self.index >= len(self.view)
 
-    def eof(self):
-        return self.index == len(self.data)
+    def eof(self) -> bool:
+        return self.index >= len(self.view)
 
-    def check_is_finished(self):
-        self.finished = self.index == len(self.data)
+    def remaining(self) -> int:
+        """Return the number of remaining bytes."""
+        return len(self.view) - self.index
+
+    def reset(self) -> None:
+        """Reset the index to the start."""
+        self.index = 0
 
-    def read(self, num_bytes: int) -> bytes:
-        """Read num_bytes from the current position."""
-        if self.index + num_bytes > len(self.data):
+    def read(self, num_bytes: int) -> memoryview:
+        """View of the next num_bytes, without moving the position."""
+        if self.index + num_bytes > len(self.view):
             raise ValueError("Not enough bytes to read")
-        result = self.data[self.index : self.index + num_bytes]
-        return result
+        return self.view[self.index : self.index + num_bytes]
 
-    def consume(self, num_bytes: int) -> bytes:
-        """Read num_bytes from the current position."""
-        if self.index + num_bytes > len(self.data):
+    def consume(self, num_bytes: int) -> memoryview:
+        """View of the next num_bytes."""
+        start = self.index
+        end = start + num_bytes
+        if end > len(self.view):
             raise ValueError("Not enough bytes to read")
-        result = self.data[self.index : self.index + num_bytes]
-        self.index += num_bytes
-        self.check_is_finished()
-        return result
+        self.index = end
+        return self.view[start:end]
 
     def skip(self, num_bytes: int) -> None:
         """Skip num_bytes in the stream by advancing the index."""
-        if self.index + num_bytes > len(self.data):
+        if self.index + num_bytes > len(self.view):
             raise ValueError("Not enough bytes to skip")
         self.index += num_bytes
-        self.check_is_finished()
 
-    def remaining(self) -> int:
-        """Return the number of remaining bytes."""
-        return len(self.data) - self.index
+    def unpack(self, fields: Struct) -> tuple:
+        values = fields.unpack_from(self.view, self.index)
+        self.index += fields.size
+        return values
 
-    def reset(self) -> None:
-        """Reset the index to the start."""
-        self.index = 0
-        self.finished = False
-
-    def consume_var_int(self, signed=True):
-        shift = 0
-        value = 0
-        aux = MSB_SET_MASK
-        index = self.index
-        record = b""
-        while aux & MSB_SET_MASK:
-            aux = self.data[index]
-            record += aux.to_bytes()
-            value += (aux & REMOVE_MSB_MASK) << shift
-            index += 1
-            shift += 7
-        if signed:
-            lsb = value & 0x01
-            if lsb:
-                value = -1 * ((value + 1) >> 1)
-            else:
-                value = value >> 1
-        self.index = index
-        self.check_is_finished()
-        return value
\ No newline at end of file
+    def int8(self) -> int:
+        (value,) = INT8.unpack_from(self.view, self.index)
+        self.index += 1
+        return value
+
+    def int16(self) -> int:
+        (value,) = INT16.unpack_from(self.view, self.index)
+        self.index += 2
+        return value
+
+    def int32(self) -> int:
+        (value,) = INT32.unpack_from(self.view, self.index)
+        self.index += 4
+        return value
+
+    def int64(self) -> int:
+        (value,) = INT64.unpack_from(self.view, self.index)
+        self.index += 8
+        return value
+
+    def uint8(self) -> int:
+        (value,) = UINT8.unpack_from(self.view, self.index)
+        self.index += 1
+        return value
+
+    def uint16(self) -> int:
+        (value,) = UINT16.unpack_from(self.view, self.index)
+        self.index += 2
+        return value
+
+    def uint32(self) -> int:
+        (value,) = UINT32.unpack_from(self.view, self.index)
+        self.index += 4
+        return value
+
+    def uuid(self) -> bytes:
+        """16 raw bytes, copied so that they can be used as a key"""
+        return bytes(self.consume(UUID_SIZE))
+
+    def uuid_int(self) -> int:
+        return int.from_bytes(self.consume(UUID_SIZE), byteorder="big")
+
+    # Single byte values, the most common ones (lengths, deltas, tag counts), are decoded
+    # inline ; longer ones in one call to decode_unsigned_varint, zigzag decoded here
+
+    def unsigned_varint(self) -> int:
+        b = self.view[self.index]
+        if b < MSB_SET_MASK:
+            self.index += 1
+            return b
+        value, self.index = decode_unsigned_varint(self.view, self.index, VARINT_MAX_BYTES)
+        return value
+
+    def varint(self) -> int:
+        value = self.view[self.index]
+        if value < MSB_SET_MASK:
+            self.index += 1
+        else:
+            value, self.index = decode_unsigned_varint(self.view, self.index, VARINT_MAX_BYTES)
+        return (value >> 1) ^ -(value & 1)
+
+    def unsigned_varlong(self) -> int:
+        b = self.view[self.index]
+        if b < MSB_SET_MASK:
+            self.index += 1
+            return b
+        value, self.index = decode_unsigned_varint(self.view, self.index, VARLONG_MAX_BYTES)
+        return value
+
+    def varlong(self) -> int:
+        value = self.view[self.index]
+        if value < MSB_SET_MASK:
+            self.index += 1
+        else:
+            value, self.index = decode_unsigned_varint(self.view, self.index, VARLONG_MAX_BYTES)
+        return (value >> 1) ^ -(value & 1)
+
+    def consume_var_int(self, signed=True) -> int:
+        return self.varlong() if signed else self.unsigned_varlong()
+
+    def compact_array_length(self) -> int:
+        """Number of elements of a compact array, -1 when null"""
+        return self.unsigned_varint() - 1
+
+    def compact_bytes(self) -> memoryview | None:
+        length = self.unsigned_varint()
+        return self.consume(length - 1) if length else None
+
+    def compact_string(self) -> bytes | None:
+        length = self.unsigned_varint()
+        return bytes(self.consume(length - 1)) if length else None
+
+    def string(self) -> bytes | None:
+        """Nullable string with an int16 length"""
+        length = self.int16()
+        return bytes(self.consume(length)) if length >= 0 else None
+
+    def int32_array(self) -> tuple:
+        """Compact array of int32, empty when null"""
+        count = self.unsigned_varint() - 1
+        if count <= 0:
+            return ()
+        return self.unpack(int32_array_struct(count))
+
+    def skip_tagged_fields(self) -> int:
+        """Skip a tagged fields section, returning the number of fields in it"""
+        count = self.unsigned_varint()
+        for _ in range(count):
+            self.unsigned_varint()  # tag
+            self.skip(self.unsigned_varint())
+        return count
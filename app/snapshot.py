@@ -0,0 +1,226 @@
+"""Snapshots of the decoded cluster metadata, so that a restarting broker replays only the
+metadata log batches appended after its last snapshot instead of the whole log (in the
+spirit of the KRaft .checkpoint files).
+
+A snapshot <last offset>.metadata-snapshot, next to the metadata log, holds the topics and
+partitions indexed by MetadataStore after the batch ending at that offset, with where that
+batch is in the log, so that a snapshot is only used for the log it was taken from.
+Layout, big endian :
+
+    header      magic, version, last offset, log position after the last batch,
+                log position of the last batch, topics count, partition table topics count
+    topics      per topic : topic id, name length (int16), name
+    partitions  topic id per topic of the compacted PartitionTable, then each of its
+                ARRAYS : length (int32) and int32 values
+    trailer     CRC-32 of all the above
+
+Version 1 snapshots, with a (partition id, replica array length, replica) tuple per
+partition, are no longer read : the log is replayed instead.
+
+Snapshots are written to a temporary file, fsynced, then renamed : a crash never leaves a
+partial snapshot under its final name, and a corrupted one fails its checksum.
+"""
+import asyncio
+import glob
+import os
+import sys
+import tempfile
+import zlib
+from array import array
+from struct import Struct
+from typing import Awaitable, Callable
+
+from .disk_io import disk_executors
+from .metadata import PartitionTable
+from .parser import ByteParser
+from .storage import BATCH_HEADER, BATCH_LENGTH_END
+
+MAGIC = b"KMSS"
+VERSION = 2
+SNAPSHOT_SUFFIX = ".metadata-snapshot"
+SNAPSHOTS_RETAINED = 2
+# magic, version, last offset, position, last batch position, topics, partition table topics
+HEADER = Struct(">4shqqqii")
+# topic id, name length
+TOPIC = Struct(">16sh")
+ARRAY_LENGTH = Struct(">i")
+TRAILER = Struct(">I")
+UUID_SIZE = 16
+SWAP_BYTES = sys.byteorder == "little"  # arrays are in native byte order
+
+
+class InvalidSnapshot(ValueError):
+    pass
+
+
+class MetadataSnapshot:
+    """Metadata indexes after the batch of the log ending at last_offset"""
+
+    __slots__ = ("last_offset", "position", "last_batch_position", "topic_names", "partitions")
+
+    def __init__(self, last_offset: int, position: int, last_batch_position: int, topic_names: dict, partitions: PartitionTable):
+        self.last_offset = last_offset
+        self.position = position  # end of the last batch in the log
+        self.last_batch_position = last_batch_position
+        self.topic_names = topic_names  # topic UUID (int) -> topic name (bytes), in creation order
+        self.partitions = partitions  # PartitionTable
+
+
+def encode_array(values: array) -> bytes:
+    if SWAP_BYTES:
+        values = array("i", values)
+        values.byteswap()
+    return ARRAY_LENGTH.pack(len(values)) + values.tobytes()
+
+
+def decode_array(parser: ByteParser) -> array:
+    (length,) = parser.unpack(ARRAY_LENGTH)
+    values = array("i")
+    values.frombytes(parser.consume(length * values.itemsize))
+    if SWAP_BYTES:
+        values.byteswap()
+    return values
+
+
+def encode(snapshot: MetadataSnapshot) -> bytes:
+    table = snapshot.partitions
+    table.compact()
+    parts = [
+        HEADER.pack(
+            MAGIC,
+            VERSION,
+            snapshot.last_offset,
+            snapshot.position,
+            snapshot.last_batch_position,
+            len(snapshot.topic_names),
+            len(table.topic_ids),
+        )
+    ]
+    for topic_id, name in snapshot.topic_names.items():
+        parts.append(TOPIC.pack(topic_id.to_bytes(16, byteorder="big"), len(name)))
+        parts.append(name)
+    parts.extend(topic_id.to_bytes(UUID_SIZE, byteorder="big") for topic_id in table.topic_ids)
+    parts.extend(encode_array(getattr(table, name)) for name in PartitionTable.ARRAYS)
+    data = b"".join(parts)
+    return data + TRAILER.pack(zlib.crc32(data))
+
+
+def decode(data: bytes) -> MetadataSnapshot:
+    """Raises:
+    InvalidSnapshot: unknown format or version, checksum mismatch, truncated file
+    """
+    if len(data) < HEADER.size + TRAILER.size:
+        raise InvalidSnapshot("truncated snapshot")
+    body = memoryview(data)[: -TRAILER.size]
+    (crc,) = TRAILER.unpack_from(data, len(body))
+    if zlib.crc32(body) != crc:
+        raise InvalidSnapshot("checksum mismatch")
+    parser = ByteParser(body)
+    magic, version, last_offset, position, last_batch_position, topics, table_topics = parser.unpack(HEADER)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidSnapshot(f"unsupported snapshot format {bytes(magic)!r} version {version}")
+    topic_names = {}
+    for _ in range(topics):
+        topic_id, name_length = parser.unpack(TOPIC)
+        topic_names[int.from_bytes(topic_id, byteorder="big")] = bytes(parser.consume(name_length))
+    table_topic_ids = [parser.uuid_int() for _ in range(table_topics)]
+    partitions = PartitionTable.from_arrays(
+        table_topic_ids, {name: decode_array(parser) for name in PartitionTable.ARRAYS}
+    )
+    return MetadataSnapshot(last_offset, position, last_batch_position, topic_names, partitions)
+
+
+def snapshot_paths(directory: str) -> list[str]:
+    """Snapshot files of directory, most recent first"""
+    return sorted(glob.glob(os.path.join(directory, "*" + SNAPSHOT_SUFFIX)), reverse=True)
+
+
+def read_snapshot(path: str) -> MetadataSnapshot:
+    with open(path, "rb") as f:
+        return decode(f.read())
+
+
+def continues_log(snapshot: MetadataSnapshot, log_path: str) -> bool:
+    """Whether the log still has the batch the snapshot was taken after, where it was then"""
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(snapshot.last_batch_position)
+            header = f.read(BATCH_HEADER.size)
+    except OSError:
+        return False
+    if len(header) < BATCH_HEADER.size:
+        return False
+    base_offset, batch_length, *_, last_offset_delta = BATCH_HEADER.unpack(header)
+    return (
+        base_offset + last_offset_delta == snapshot.last_offset
+        and snapshot.last_batch_position + BATCH_LENGTH_END + batch_length == snapshot.position
+    )
+
+
+def latest_snapshot(directory: str, log_path: str) -> MetadataSnapshot | None:
+    """Most recent valid snapshot of directory taken from the log at log_path, None if there
+    is none. Blocking : run in the disk executor of the log"""
+    for snapshot_path in snapshot_paths(directory):
+        try:
+            snapshot = read_snapshot(snapshot_path)
+        except (OSError, InvalidSnapshot) as e:
+            print(f"Ignoring metadata snapshot {snapshot_path} : {e}")
+            continue
+        if continues_log(snapshot, log_path):
+            return snapshot
+    return None
+
+
+def write_snapshot(directory: str, snapshot: MetadataSnapshot, data: bytes, retained: int = SNAPSHOTS_RETAINED) -> str:
+    """Write the encoded snapshot atomically, then delete the older snapshots beyond the
+    retained most recent ones"""
+    path = os.path.join(directory, f"{snapshot.last_offset:020d}{SNAPSHOT_SUFFIX}")
+    # a unique temporary file : the worker being replaced by a graceful restart may
+    # still be writing the same snapshot
+    fd, temporary = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path) + ".", dir=directory)
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+    paths = snapshot_paths(directory)
+    # snapshots past this one were taken from a log since replaced or truncated
+    stale = [old for old in paths if old > path]
+    current = [old for old in paths if old <= path]
+    for old in stale + current[max(retained, 1) :]:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+    return path
+
+
+async def write_snapshots_periodically(directory: str, take: Callable[[], Awaitable[MetadataSnapshot | None]], interval_ms: int, retained: int = SNAPSHOTS_RETAINED) -> None:
+    """Background task writing a snapshot every interval_ms when take() gives one.
+    The indexes are compacted and copied on the event loop, so that the snapshot is
+    consistent while the loop keeps applying the metadata log, then encoded and written in
+    the disk executor of directory."""
+    while True:
+        snapshot = await take()
+        if snapshot is not None:
+            snapshot.partitions.compact()  # the live table : compacted where it is used
+            snapshot = MetadataSnapshot(
+                snapshot.last_offset,
+                snapshot.position,
+                snapshot.last_batch_position,
+                dict(snapshot.topic_names),
+                snapshot.partitions.copy(),
+            )
+            try:
+                data = await disk_executors.run(directory, encode, snapshot)
+                await disk_executors.run(directory, write_snapshot, directory, snapshot, data, retained)
+            except OSError as e:
+                print(f"Metadata snapshot at offset {snapshot.last_offset} failed : {e}")
+        await asyncio.sleep(interval_ms / 1000)
@@ -0,0 +1,761 @@
+"""On-disk partition data : segment indexes read by Fetch and the append path of Produce.
+
+Once the event loop runs, the calls reading or writing the files of a partition (load,
+refresh, slice, appends, retention) run in the disk executor of the partition directory,
+holding the io_lock of its PartitionLog : the event loop only reads the offsets.
+"""
+import asyncio
+import fcntl
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right, insort
+from collections import OrderedDict
+
+from .disk_io import disk_executors
+
+try:
+    from crc32c import crc32c as _crc32c
+except ImportError:  # optional accelerated implementation
+    _crc32c = None
+
+# base offset, batch length, partition leader epoch, magic, crc, attributes, last offset delta
+BATCH_HEADER = struct.Struct(">qiibIhi")
+BATCH_LENGTH_END = 12  # the batch length counts the bytes following the base offset and itself
+INDEX_INTERVAL_BYTES = 4096
+BATCH_BASE_OFFSET = struct.Struct(">q")
+BATCH_CRC_END = 21  # the CRC covers the batch from the attributes to its end
+BATCH_RECORDS_START = 61  # size of a record batch without any record
+MAGIC_V2 = 2
+# larger record sets are validated in the disk executor : the CRC of the pure Python
+# fallback costs about 0.2 s per MiB
+VALIDATE_INLINE_BYTES = 65536 if _crc32c is not None else 4096
+
+SEGMENT_SUFFIX = ".log"
+LOCK_FILE = ".lock"  # flocked by the processes appending to a shared partition
+DIRECTORY_MTIME_SETTLED_NS = 1_000_000_000
+SEGMENT_BYTES = 1073741824  # log.segment.bytes
+SEGMENT_MS = 604800000  # log.roll.ms
+MAX_MAPPED_SEGMENTS = 64
+
+FLUSH_ON_BATCH = "batch"  # fsync every group commit before acknowledging it
+FLUSH_ON_INTERVAL = "interval"  # fsync at most every flush_interval_ms
+FLUSH_BY_OS = "os"  # never fsync, leave it to the OS page cache writeback
+
+
+class FileRegion:
+    """A byte range of a segment file.
+
+    Handlers put a FileRegion in a response instead of the bytes themselves; the server
+    streams the range straight from the file to the socket. The segment may be opened when
+    the region is located, holding the io_lock of its log (see open_region) : retention
+    deleting the segment before the region is sent then leaves the open file readable.
+    """
+
+    __slots__ = ("path", "offset", "count", "file")
+
+    def __init__(self, path: str, offset: int, count: int, file=None):
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.file = file  # the segment opened by open_region, owned by whoever sends the region
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __repr__(self) -> str:
+        return f"FileRegion({self.path!r}, offset={self.offset}, count={self.count})"
+
+
+class OffsetIndex:
+    """Sparse offset -> file position index of a segment, in the spirit of Kafka's .index files.
+
+    An entry is kept for the first batch and then for the first batch following every
+    index_interval_bytes of data. The index is built by scanning the batch headers of the
+    segment and is extended incrementally when batches are appended.
+    """
+
+    def __init__(self, path: str, base_offset: int = 0, index_interval_bytes: int = INDEX_INTERVAL_BYTES):
+        self.path = path
+        self.base_offset = base_offset
+        self.index_interval_bytes = index_interval_bytes
+        self.offsets = array("q")  # base offset of the indexed batches
+        self.positions = array("q")  # file position of the indexed batches
+        self.size = 0  # end of the last complete batch
+        self.next_offset = base_offset  # offset following the last record of the segment
+        self.bytes_since_last_entry = 0
+
+    def refresh(self) -> None:
+        """Index the complete batches appended since the last refresh"""
+        try:
+            file_size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            file_size = 0
+        if file_size < self.size:
+            # truncated or replaced segment
+            self.offsets = array("q")
+            self.positions = array("q")
+            self.size = self.bytes_since_last_entry = 0
+            self.next_offset = self.base_offset
+        if file_size - self.size < BATCH_HEADER.size:
+            return
+        with open(self.path, "rb") as f:
+            for position, base_offset, last_offset, batch_size in iter_batch_headers(
+                f, self.size, file_size
+            ):
+                if not self.offsets or self.bytes_since_last_entry >= self.index_interval_bytes:
+                    self.offsets.append(base_offset)
+                    self.positions.append(position)
+                    self.bytes_since_last_entry = 0
+                self.bytes_since_last_entry += batch_size
+                self.size = position + batch_size
+                self.next_offset = last_offset + 1
+
+    def lookup(self, offset: int) -> int:
+        """Return the file position of the last indexed batch whose base offset is <= offset"""
+        entry = bisect_right(self.offsets, offset) - 1
+        return self.positions[entry] if entry >= 0 else 0
+
+    def slice(self, fetch_offset: int, max_bytes: int) -> tuple[int, int]:
+        """Locate the batches to return for a fetch starting at fetch_offset.
+
+        The first batch containing fetch_offset is always returned, even when it is larger
+        than max_bytes, so that consumers make progress; further batches are added while
+        they fit in max_bytes.
+
+        Returns:
+            tuple[int, int]: file position and byte count of the batches
+        """
+        if fetch_offset >= self.next_offset or not self.offsets:
+            return self.size, 0
+        start = None
+        end = self.size
+        with open(self.path, "rb") as f:
+            for position, _base_offset, last_offset, batch_size in iter_batch_headers(
+                f, self.lookup(fetch_offset), self.size
+            ):
+                if start is None:
+                    if last_offset < fetch_offset:
+                        continue
+                    start = position
+                elif position + batch_size - start > max_bytes:
+                    end = position
+                    break
+        if start is None:
+            return self.size, 0
+        return start, end - start
+
+
+def iter_batch_headers(f, position: int, end: int):
+    """Walk the record batch headers of an opened segment between position and end.
+
+    Yields:
+        tuple[int, int, int, int]: position, base offset, last offset and size of each complete batch
+    """
+    while position + BATCH_HEADER.size <= end:
+        f.seek(position)
+        header = f.read(BATCH_HEADER.size)
+        if len(header) < BATCH_HEADER.size:
+            return
+        base_offset, batch_length, *_, last_offset_delta = BATCH_HEADER.unpack(header)
+        batch_size = BATCH_LENGTH_END + batch_length
+        if position + batch_size > end:
+            # batch still being written
+            return
+        yield position, base_offset, base_offset + last_offset_delta, batch_size
+        position += batch_size
+
+
+def _crc32c_table() -> list[int]:
+    table = []
+    for n in range(256):
+        for _ in range(8):
+            n = (n >> 1) ^ 0x82F63B78 if n & 1 else n >> 1
+        table.append(n)
+    return table
+
+
+CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data) -> int:
+    """CRC-32C (Castagnoli) used by record batches, from the crc32c package when installed"""
+    if _crc32c is not None:
+        return _crc32c(data)
+    crc = 0xFFFFFFFF
+    table = CRC32C_TABLE
+    for b in data:
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+class InvalidRecordBatch(ValueError):
+    pass
+
+
+class OffsetOutOfRange(LookupError):
+    pass
+
+
+def validate_record_batches(data) -> list[tuple[int, int, int]]:
+    """Check that data is a sequence of complete, uncorrupted v2 record batches.
+
+    Returns:
+        list[tuple[int, int, int]]: position, size and last offset delta of each batch
+    Raises:
+        InvalidRecordBatch: truncated batch, unsupported magic byte or CRC mismatch
+    """
+    batches = []
+    position = 0
+    view = memoryview(data)
+    while position < len(data):
+        if len(data) - position < BATCH_RECORDS_START:
+            raise InvalidRecordBatch(f"truncated record batch at {position}")
+        _base_offset, batch_length, _epoch, magic, crc, _attributes, last_offset_delta = (
+            BATCH_HEADER.unpack_from(data, position)
+        )
+        batch_size = BATCH_LENGTH_END + batch_length
+        if batch_size < BATCH_RECORDS_START or position + batch_size > len(data):
+            raise InvalidRecordBatch(f"invalid batch length {batch_length} at {position}")
+        if magic != MAGIC_V2:
+            raise InvalidRecordBatch(f"unsupported magic byte {magic} at {position}")
+        if crc32c(view[position + BATCH_CRC_END : position + batch_size]) != crc:
+            raise InvalidRecordBatch(f"CRC mismatch at {position}")
+        batches.append((position, batch_size, last_offset_delta))
+        position += batch_size
+    return batches
+
+
+async def validate_record_batches_async(data, directory: str, inline_bytes: int = VALIDATE_INLINE_BYTES) -> list[tuple[int, int, int]]:
+    """validate_record_batches, run in the disk executor of directory when data is larger
+    than inline_bytes, so that large record sets do not hold the event loop"""
+    if len(data) <= inline_bytes:
+        return validate_record_batches(data)
+    return await disk_executors.run(directory, validate_record_batches, data)
+
+
+class PartitionAppender:
+    """Append-only writer of the active segment of a partition, with group commit.
+
+    Appends are queued; a single flush task per partition assigns their offsets and
+    writes everything queued since the previous write in one write call (and one fsync,
+    depending on the flush policy), so that concurrent producers share the cost of the
+    write and of the fsync. The active segment is rolled before a write that would make
+    it exceed segment_bytes or when it is older than segment_ms.
+
+    When the log is shared with other processes, each group is written holding an
+    exclusive flock on the partition lock file, after picking up what the other
+    processes appended, so that offsets stay contiguous whoever writes.
+    """
+
+    def __init__(self, log: "PartitionLog", flush_policy: str = FLUSH_ON_BATCH, flush_interval_ms: int = 1000):
+        self.log = log
+        self.flush_policy = flush_policy
+        self.flush_interval_ms = flush_interval_ms
+        self.pending = []  # (batches, batch layout, future) not yet written
+        self.flusher = None
+        self.fsync_timer = None
+        self.syncing = None  # fsync of FLUSH_ON_INTERVAL in the disk executor
+        self.fd = None
+        self.fd_path = None
+        self.lock_fd = None
+        self.offline = None  # error that left torn bytes in the active segment
+
+    def append(self, data, batches: list[tuple[int, int, int]]) -> asyncio.Future:
+        """Queue validated batches for the next group commit.
+
+        Returns:
+            asyncio.Future: done once the batches are written, with the offset of their first record
+        """
+        written = asyncio.get_running_loop().create_future()
+        self.pending.append((bytearray(data), batches, written))
+        if self.flusher is None:
+            self.flusher = asyncio.get_running_loop().create_task(self.flush_pending())
+        return written
+
+    def assign_offsets(self, group: list) -> list[int]:
+        """Patch the base offsets of the batches of a group, following the end of the log"""
+        next_offset = self.log.next_offset
+        base_offsets = []
+        for data, batches, _ in group:
+            base_offsets.append(next_offset)
+            for position, _batch_size, last_offset_delta in batches:
+                BATCH_BASE_OFFSET.pack_into(data, position, next_offset)
+                next_offset += last_offset_delta + 1
+        return base_offsets
+
+    async def flush_pending(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self.pending:
+                group, self.pending = self.pending, []
+                try:
+                    base_offsets = await disk_executors.run(self.log.directory, self.write_group, group)
+                except OSError as e:
+                    for _, _, written in group:
+                        if not written.done():
+                            written.set_exception(e)
+                    continue
+                for (_, _, written), base_offset in zip(group, base_offsets):
+                    if not written.done():
+                        written.set_result(base_offset)
+                self.log.notify_waiters()
+                if self.flush_policy == FLUSH_ON_INTERVAL and self.fsync_timer is None:
+                    self.fsync_timer = loop.call_later(
+                        self.flush_interval_ms / 1000, self.schedule_fsync
+                    )
+        finally:
+            self.flusher = None
+
+    def write_group(self, group: list) -> list[int]:
+        """Assign the offsets of a group, roll the active segment when needed, write the group
+        and index it, holding the io_lock of the log (and the partition flock when shared).
+        Blocking : run in the disk executor of the log.
+
+        Returns:
+            list[int]: base offset of each append of the group
+        """
+        if self.offline is not None:
+            raise OSError(f"{self.log.directory} is offline : {self.offline}")
+        if self.log.shared:
+            self.lock()
+        try:
+            with self.log.io_lock:
+                if self.log.shared:
+                    # batches and segments of the other processes
+                    self.log.sync_segments(force=True)
+                    self.log.active.refresh()
+                base_offsets = self.assign_offsets(group)
+                chunks = [data for data, _, _ in group]
+                if self.log.should_roll(sum(map(len, chunks))):
+                    self.log.roll(base_offsets[0])
+                self.write(self.log.active.path, chunks, self.flush_policy == FLUSH_ON_BATCH)
+                self.log.active.refresh()
+                self.log.appended_bytes += sum(map(len, chunks))
+        finally:
+            if self.log.shared:
+                self.unlock()
+        return base_offsets
+
+    def lock(self) -> None:
+        if self.lock_fd is None:
+            os.makedirs(self.log.directory, exist_ok=True)
+            self.lock_fd = os.open(os.path.join(self.log.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+    def unlock(self) -> None:
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def write(self, path: str, chunks: list, fsync: bool) -> None:
+        if self.fd_path != path:
+            # first write, or the active segment was rolled
+            if self.fd is not None:
+                if self.flush_policy != FLUSH_BY_OS:
+                    os.fsync(self.fd)  # the sealed segment is not written to anymore
+                os.close(self.fd)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.fd_path = path
+        data = b"".join(chunks)
+        size = os.lseek(self.fd, 0, os.SEEK_END)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            if fsync:
+                os.fsync(self.fd)
+        except OSError as e:
+            # the group fails as a whole : drop its bytes already written, so that
+            # neither the index nor the fetches ever see a torn batch
+            try:
+                os.ftruncate(self.fd, size)
+            except OSError:
+                self.offline = e
+            raise
+
+    def schedule_fsync(self) -> None:
+        self.fsync_timer = None
+        if self.syncing is not None:
+            # previous fsync still running : sync what was written since on the next interval
+            self.fsync_timer = asyncio.get_running_loop().call_later(self.flush_interval_ms / 1000, self.schedule_fsync)
+        elif self.fd is not None:
+            self.syncing = asyncio.ensure_future(disk_executors.run(self.log.directory, self.sync))
+            self.syncing.add_done_callback(self.synced)
+
+    def sync(self) -> None:
+        """fsync the active segment, holding the io_lock so that the file descriptor is not
+        closed by a roll or by close() meanwhile. Blocking : run in the disk executor"""
+        with self.log.io_lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+
+    def synced(self, syncing: asyncio.Future) -> None:
+        self.syncing = None
+        if not syncing.cancelled() and syncing.exception() is not None:
+            print(f"fsync of {self.fd_path} failed : {syncing.exception()}")
+
+    def close(self) -> None:
+        if self.fsync_timer is not None:
+            self.fsync_timer.cancel()
+            self.fsync_timer = None
+        if self.syncing is not None:
+            self.syncing.cancel()  # an fsync already running holds the io_lock until it is done
+        with self.log.io_lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = self.fd_path = None
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+class PartitionLog:
+    """A partition directory : an ordered set of segments named after the offset of their
+    first record, the last one being the active segment that receives appends."""
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = SEGMENT_BYTES,
+        segment_ms: int = SEGMENT_MS,
+        flush_policy: str = FLUSH_ON_BATCH,
+        flush_interval_ms: int = 1000,
+        shared: bool = False,
+    ):
+        self.directory = directory
+        self.shared = shared  # appended to by other processes too (multi-process mode)
+        self.segment_bytes = segment_bytes
+        self.segment_ms = segment_ms
+        self.base_offsets = []  # sorted base offsets of the segments
+        self.segments = {}  # base offset -> OffsetIndex
+        self.active_since = time.time()
+        self.waiters = set()  # DelayedFetch parked on this partition
+        self.appended_bytes = 0  # written by the appender of this process, changed under io_lock
+        self.directory_mtime = None  # changes when segments are created or deleted
+        self.io_lock = threading.RLock()  # held by the threads reading or changing the segments
+        self.load()
+        self.appender = PartitionAppender(self, flush_policy, flush_interval_ms)
+
+    def segment_path(self, base_offset: int) -> str:
+        return os.path.join(self.directory, f"{base_offset:020d}{SEGMENT_SUFFIX}")
+
+    def scan(self) -> list[int]:
+        """Base offsets of the segments in the partition directory"""
+        base_offsets = []
+        for path in glob.glob(os.path.join(self.directory, "*" + SEGMENT_SUFFIX)):
+            name = os.path.basename(path)[: -len(SEGMENT_SUFFIX)]
+            if name.isdigit():
+                base_offsets.append(int(name))
+        return sorted(base_offsets)
+
+    def load(self) -> None:
+        """Index the segments found in the partition directory"""
+        self.base_offsets = []
+        self.segments = {}
+        self.directory_mtime = self.stat_directory()
+        for base_offset in self.scan():
+            self.add_segment(base_offset)
+        if not self.base_offsets:
+            self.add_segment(0)
+        else:
+            try:
+                self.active_since = os.stat(self.active.path).st_mtime
+            except FileNotFoundError:
+                pass
+
+    def stat_directory(self) -> int | None:
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def sync_segments(self, force: bool = False) -> None:
+        """Follow the segments rolled or deleted by the other processes sharing the directory.
+
+        The directory is only scanned when its mtime changed, unless force is set. File system
+        timestamps are coarse : an mtime that is too recent may be shared by a later change,
+        so it is not remembered.
+        """
+        mtime = self.stat_directory()
+        if mtime is None or (mtime == self.directory_mtime and not force):
+            return
+        self.directory_mtime = mtime if time.time_ns() - mtime > DIRECTORY_MTIME_SETTLED_NS else None
+        found = self.scan()
+        if not found:
+            return
+        added = [b for b in found if b not in self.segments]
+        if added:
+            self.active.refresh()  # last batches written before the other process rolled it
+        for base_offset in [b for b in self.base_offsets if b < found[0]]:
+            del self.segments[base_offset]
+            self.base_offsets.remove(base_offset)
+        for base_offset in added:
+            self.add_segment(base_offset)
+        if added:
+            self.active_since = time.time()
+
+    def add_segment(self, base_offset: int) -> None:
+        index = OffsetIndex(self.segment_path(base_offset), base_offset)
+        index.refresh()
+        self.segments[base_offset] = index
+        insort(self.base_offsets, base_offset)
+
+    @property
+    def active(self) -> OffsetIndex:
+        return self.segments[self.base_offsets[-1]]
+
+    @property
+    def log_start_offset(self) -> int:
+        return self.base_offsets[0]
+
+    @property
+    def next_offset(self) -> int:
+        return self.active.next_offset
+
+    def notify_waiters(self) -> None:
+        """Wake the fetches parked on this partition up after an append"""
+        for waiter in tuple(self.waiters):
+            waiter.on_append()
+
+    def refresh(self) -> None:
+        """Pick up batches appended to the active segment by another writer"""
+        if self.shared:
+            self.sync_segments()
+        self.active.refresh()
+
+    def segment_for(self, offset: int) -> OffsetIndex:
+        """Binary search the segment containing offset"""
+        return self.segments[self.base_offsets[max(bisect_right(self.base_offsets, offset) - 1, 0)]]
+
+    def slice(self, fetch_offset: int, max_bytes: int) -> FileRegion | None:
+        """Locate the batches to return for a fetch starting at fetch_offset (see OffsetIndex.slice).
+        Holds the io_lock : retention does not drop a segment while it is read.
+        Raises OffsetOutOfRange below the log start or past the log end, fetching
+        at the log end is a valid fetch returning None"""
+        with self.io_lock:
+            if not self.log_start_offset <= fetch_offset <= self.next_offset:
+                raise OffsetOutOfRange(fetch_offset)
+            segment = self.segment_for(fetch_offset)
+            while True:
+                position, count = segment.slice(fetch_offset, max_bytes)
+                if count:
+                    return FileRegion(segment.path, position, count)
+                # fetch_offset may be past the last batch of a sealed segment
+                following = bisect_right(self.base_offsets, segment.base_offset)
+                if following == len(self.base_offsets):
+                    return None
+                segment = self.segments[self.base_offsets[following]]
+
+    def should_roll(self, incoming_bytes: int) -> bool:
+        active = self.active
+        return active.size > 0 and (
+            active.size + incoming_bytes > self.segment_bytes
+            or (time.time() - self.active_since) * 1000 >= self.segment_ms
+        )
+
+    def roll(self, base_offset: int) -> None:
+        """Seal the active segment, the next appends go to a new segment starting at base_offset"""
+        self.add_segment(base_offset)
+        self.active_since = time.time()
+
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments.values())
+
+    def remove_expired_segments(self, retention_bytes: int, retention_ms: int, modified: dict[int, float]) -> list[str]:
+        """Drop the oldest sealed segments exceeding the retention limits from the log.
+
+        Args:
+            retention_bytes (int): maximum size of the partition, -1 for no limit
+            retention_ms (int): maximum age of the last write to a segment, -1 for no limit
+            modified (dict[int, float]): last modification time of the sealed segments, by base offset
+        Returns:
+            list[str]: paths of the removed segments, for the caller to delete
+        """
+        removed = []
+        with self.io_lock:
+            excess = self.size() - retention_bytes if retention_bytes >= 0 else 0
+            now = time.time()
+            while len(self.base_offsets) > 1:
+                oldest = self.segments[self.base_offsets[0]]
+                too_big = excess - oldest.size >= 0 and retention_bytes >= 0
+                too_old = retention_ms >= 0 and (now - modified.get(oldest.base_offset, now)) * 1000 > retention_ms
+                if not (too_big or too_old):
+                    break
+                excess -= oldest.size
+                del self.segments[self.base_offsets.pop(0)]
+                removed.append(oldest.path)
+        return removed
+
+
+class DelayedFetch:
+    """A fetch parked until min_bytes are appended to its partitions or max_wait_ms expires.
+
+    The fetch registers itself in the waiters of each partition it reads, and the appenders
+    wake it up after they write : nothing polls. The bytes appended since the fetch read the
+    partitions are counted from their appended_bytes, as seen by that read, so that appends
+    completed between the read and the registration count too. The only timer is the expiry,
+    one call_later handle per parked fetch, kept by the event loop in a heap.
+    """
+
+    __slots__ = ("future", "bytes_needed", "logs", "timer")
+
+    def __init__(self, logs: dict[PartitionLog, int], bytes_needed: int, max_wait_ms: int):
+        """Args:
+            logs (dict): partition log -> its appended_bytes when the fetch read it
+        """
+        loop = asyncio.get_running_loop()
+        self.future = loop.create_future()
+        self.bytes_needed = bytes_needed
+        self.logs = logs
+        for log in logs:
+            log.waiters.add(self)
+        self.timer = loop.call_later(max_wait_ms / 1000, self.complete)
+        self.on_append()
+
+    def on_append(self) -> None:
+        if sum(log.appended_bytes - seen for log, seen in self.logs.items()) >= self.bytes_needed:
+            self.complete()
+
+    def complete(self) -> None:
+        self.timer.cancel()
+        for log in self.logs:
+            log.waiters.discard(self)
+        if not self.future.done():
+            self.future.set_result(None)
+
+    async def wait(self) -> None:
+        try:
+            await self.future
+        finally:
+            self.complete()  # also unregisters a fetch cancelled with its connection
+
+
+class MappedSegments:
+    """Read-only memory maps of sealed segments, least recently used first.
+
+    Fetch slices are served as memoryviews over the mappings, so their bytes are never
+    copied before reaching the socket. At most max_mapped segments stay mapped; a mapping
+    evicted while a slice of it is still being sent is closed once that slice is released.
+    """
+
+    def __init__(self, max_mapped: int = MAX_MAPPED_SEGMENTS):
+        self.max_mapped = max_mapped
+        self.maps = OrderedDict()  # path -> mmap
+        self.closing = []  # evicted mappings with exported memoryviews
+        self.lock = threading.Lock()  # views are made by the disk executor threads
+
+    def view(self, region: FileRegion) -> memoryview:
+        with self.lock:
+            mapping = self.maps.get(region.path)
+            if mapping is None:
+                with open(region.path, "rb") as f:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[region.path] = mapping
+                while len(self.maps) > self.max_mapped:
+                    self.close(self.maps.popitem(last=False)[1])
+            else:
+                self.maps.move_to_end(region.path)
+            self.close_released()
+            return memoryview(mapping)[region.offset : region.offset + region.count]
+
+    def discard(self, path: str) -> None:
+        with self.lock:
+            mapping = self.maps.pop(path, None)
+            if mapping is not None:
+                self.close(mapping)
+
+    def close(self, mapping: mmap.mmap) -> None:
+        try:
+            mapping.close()
+        except BufferError:
+            self.closing.append(mapping)
+
+    def close_released(self) -> None:
+        if self.closing:
+            closing, self.closing = self.closing, []
+            for mapping in closing:
+                self.close(mapping)
+
+
+mapped_segments = MappedSegments()
+partition_logs: dict[str, PartitionLog] = {}
+partition_logs_lock = threading.Lock()
+
+
+def partition_log(directory: str, **settings) -> PartitionLog:
+    """Return the log of a partition directory, loading it on first use, refreshed otherwise.
+    Blocking : run in the disk executor of the directory once the event loop runs"""
+    log = partition_logs.get(directory)
+    if log is None:
+        with partition_logs_lock:
+            log = partition_logs.get(directory)
+            if log is None:
+                log = partition_logs[directory] = PartitionLog(directory, **settings)
+                return log
+    with log.io_lock:
+        log.refresh()
+    return log
+
+
+def open_region(region: FileRegion):
+    """Open the segment of a region and have the OS read the region ahead, so that sending it
+    does not wait for the disk. Blocking : run in the disk executor of the segment"""
+    f = open(region.path, "rb")
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), region.offset, region.count, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+    return f
+
+
+def load_partition_logs(logs_dir: str, **settings) -> None:
+    """(Re)load every partition directory found under logs_dir, except the cluster metadata"""
+    partition_logs.clear()
+    for directory in glob.glob(os.path.join(logs_dir, "*-*")):
+        if os.path.isdir(directory) and not os.path.basename(directory).startswith("__"):
+            partition_log(directory.rstrip(os.sep), **settings)
+
+
+def sealed_segments_mtime(log: PartitionLog) -> dict[int, float]:
+    modified = {}
+    for base_offset in log.base_offsets[:-1]:
+        try:
+            modified[base_offset] = os.stat(log.segments[base_offset].path).st_mtime
+        except FileNotFoundError:
+            pass
+    return modified
+
+
+def delete_segments(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def expire_segments(log: PartitionLog, retention_bytes: int, retention_ms: int) -> list[str]:
+    """Drop the segments of a log past the retention limits and delete their files.
+    Blocking : run in the disk executor of the log"""
+    with log.io_lock:
+        removed = log.remove_expired_segments(retention_bytes, retention_ms, sealed_segments_mtime(log))
+    delete_segments(removed)
+    return removed
+
+
+async def enforce_retention(retention_bytes: int, retention_ms: int, check_interval_ms: int) -> None:
+    """Background task deleting whole segments past the retention limits, in the disk
+    executor of each partition"""
+    while True:
+        await asyncio.sleep(check_interval_ms / 1000)
+        for log in list(partition_logs.values()):
+            removed = await disk_executors.run(
+                log.directory, expire_segments, log, retention_bytes, retention_ms
+            )
+            for path in removed:
+                mapped_segments.discard(path)
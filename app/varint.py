@@ -0,0 +1,130 @@
+"""Varint / varlong codec used by the Kafka wire protocol and the record batch format.
+
+Unsigned varints are little-endian base 128 (7 bits per byte, MSB set when another byte
+follows); signed varints are zigzag encoded first. Decoders work on (buffer, offset)
+pairs, where buffer is anything indexable returning ints (bytes, bytearray, memoryview),
+and return the decoded value together with the offset of the next byte.
+"""
+from typing import BinaryIO
+
+MSB_SET_MASK = 0b10000000
+REMOVE_MSB_MASK = 0b01111111
+VARINT_MAX_BYTES = 5
+VARLONG_MAX_BYTES = 10
+
+
+def zigzag_encode(n: int) -> int:
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+def zigzag_decode(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def decode_unsigned_varint(buf, offset: int = 0, max_bytes: int = VARINT_MAX_BYTES) -> tuple[int, int]:
+    # values of up to 3 bytes, most of the lengths and offset deltas, are decoded unrolled
+    b = buf[offset]
+    if b < MSB_SET_MASK:
+        return b, offset + 1
+    value = b & REMOVE_MSB_MASK
+    b = buf[offset + 1]
+    if b < MSB_SET_MASK:
+        return value | b << 7, offset + 2
+    value |= (b & REMOVE_MSB_MASK) << 7
+    b = buf[offset + 2]
+    if b < MSB_SET_MASK:
+        return value | b << 14, offset + 3
+    value |= (b & REMOVE_MSB_MASK) << 14
+    shift = 21
+    end = offset + max_bytes
+    offset += 3
+    while offset < end:
+        b = buf[offset]
+        offset += 1
+        value |= (b & REMOVE_MSB_MASK) << shift
+        if b < MSB_SET_MASK:
+            return value, offset
+        shift += 7
+    raise ValueError(f"varint longer than {max_bytes} bytes")
+
+
+def decode_varint(buf, offset: int = 0) -> tuple[int, int]:
+    value, offset = decode_unsigned_varint(buf, offset, VARINT_MAX_BYTES)
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def decode_unsigned_varlong(buf, offset: int = 0) -> tuple[int, int]:
+    return decode_unsigned_varint(buf, offset, VARLONG_MAX_BYTES)
+
+
+def decode_varlong(buf, offset: int = 0) -> tuple[int, int]:
+    value, offset = decode_unsigned_varint(buf, offset, VARLONG_MAX_BYTES)
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def decode_varints(buf, offset: int, count: int, signed: bool = True) -> tuple[list[int], int]:
+    """Decode count consecutive varints in one call.
+
+    Returns:
+        tuple[list[int], int]: the decoded values and the offset following the last one
+    """
+    values = []
+    append = values.append
+    for _ in range(count):
+        b = buf[offset]
+        offset += 1
+        if b < MSB_SET_MASK:
+            value = b
+        else:
+            value = b & REMOVE_MSB_MASK
+            shift = 7
+            while True:
+                b = buf[offset]
+                offset += 1
+                value |= (b & REMOVE_MSB_MASK) << shift
+                if b < MSB_SET_MASK:
+                    break
+                shift += 7
+                if shift >= 7 * VARLONG_MAX_BYTES:
+                    raise ValueError(f"varint longer than {VARLONG_MAX_BYTES} bytes")
+        append((value >> 1) ^ -(value & 1) if signed else value)
+    return values, offset
+
+
+def encode_unsigned_varint(value: int) -> bytes:
+    if value < MSB_SET_MASK:
+        return bytes((value,))
+    out = bytearray()
+    while value >= MSB_SET_MASK:
+        out.append((value & REMOVE_MSB_MASK) | MSB_SET_MASK)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_varint(value: int) -> bytes:
+    return encode_unsigned_varint(zigzag_encode(value))
+
+
+encode_varlong = encode_varint
+
+
+def read_unsigned_varint(f: BinaryIO, max_bytes: int = VARLONG_MAX_BYTES) -> int:
+    """Decode an unsigned varint directly from a binary file object"""
+    value = 0
+    shift = 0
+    for _ in range(max_bytes):
+        b = f.read(1)
+        if not b:
+            raise EOFError("truncated varint")
+        b = b[0]
+        value |= (b & REMOVE_MSB_MASK) << shift
+        if b < MSB_SET_MASK:
+            return value
+        shift += 7
+    raise ValueError(f"varint longer than {max_bytes} bytes")
+
+
+def read_varint(f: BinaryIO) -> int:
+    """Decode a zigzag encoded varint directly from a binary file object"""
+    return zigzag_decode(read_unsigned_varint(f))
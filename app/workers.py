@@ -0,0 +1,156 @@
+"""Multi-process mode : N forked workers, each running its own event loop and listening on
+the same port with SO_REUSEPORT, so that the kernel spreads the connections over them.
+
+The master prepares what the workers share before forking (the decoded metadata and the
+partition indexes), so that they start with it in copy-on-write memory instead of each
+parsing the logs again. It then only supervises them : a worker that exits is replaced,
+SIGHUP replaces the workers one at a time (graceful restart), SIGTERM and SIGINT stop
+them all.
+
+The tasks that must run in a single process (retention, metadata snapshots) run in
+worker 0, holding SingletonLock : during a graceful restart the new worker 0 serves at
+once but starts them only once the old one has exited.
+"""
+import asyncio
+import fcntl
+import os
+import signal
+import sys
+import time
+import traceback
+from typing import Callable
+
+SUPERVISOR_SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGINT, signal.SIGTERM}
+RESTART_DELAY_S = 1.0  # delay before replacing a worker that exited sooner than this after starting
+STOP_TIMEOUT_S = 30.0  # time given to the workers to finish their requests before SIGKILL
+SINGLETON_LOCK_FILE = ".singleton.lock"
+SINGLETON_POLL_S = 0.1
+
+
+class WorkerPool:
+    """Fork and supervise the worker processes.
+
+    Args:
+        workers (int): number of worker processes
+        run_worker (Callable[[int], None]): body of a worker, given its index
+        before_fork (Callable[[], None]): run in the master before each fork, to bring the shared state up to date
+    """
+
+    def __init__(self, workers: int, run_worker: Callable[[int], None], before_fork: Callable[[], None] = None):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.before_fork = before_fork
+        self.pids = {}  # pid -> worker index
+        self.started = {}  # worker index -> start time of its current process
+        self.retiring = set()  # pids replaced by a graceful restart, not to be replaced again
+
+    def spawn(self, index: int) -> int:
+        if self.before_fork is not None:
+            self.before_fork()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops the workers with SIGTERM
+            for signum in (signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SUPERVISOR_SIGNALS)
+            status = 0
+            try:
+                self.run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        self.pids[pid] = index
+        self.started[index] = time.monotonic()
+        return pid
+
+    def run(self) -> None:
+        """Start the workers and supervise them until SIGTERM or SIGINT"""
+        # signals are blocked and consumed synchronously with sigwaitinfo : no handler
+        # interrupts the master in the middle of a fork or of a wait
+        signal.pthread_sigmask(signal.SIG_BLOCK, SUPERVISOR_SIGNALS)
+        for index in range(self.workers):
+            self.spawn(index)
+        while True:
+            signum = signal.sigwaitinfo(SUPERVISOR_SIGNALS).si_signo
+            if signum == signal.SIGCHLD:
+                self.reap()
+            elif signum == signal.SIGHUP:
+                self.restart()
+            else:
+                self.stop()
+                return
+
+    def reap(self) -> None:
+        """Collect the exited workers and replace the ones that were not asked to stop"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index = self.pids.pop(pid, None)
+            if index is None or pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            print(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+            if time.monotonic() - self.started[index] < RESTART_DELAY_S:
+                time.sleep(RESTART_DELAY_S)  # do not spin on a worker failing at startup
+            self.spawn(index)
+
+    def restart(self) -> None:
+        """Replace each worker by a new process, the old one finishing its requests"""
+        for pid, index in list(self.pids.items()):
+            if pid in self.retiring:
+                continue
+            self.spawn(index)
+            self.retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+
+    def stop(self) -> None:
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + STOP_TIMEOUT_S
+        while self.pids:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or signal.sigtimedwait({signal.SIGCHLD}, remaining) is None:
+                break
+            for _ in range(len(self.pids)):
+                try:
+                    pid, _status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    self.pids.clear()
+                    break
+                if pid == 0:
+                    break
+                self.pids.pop(pid, None)
+        for pid in self.pids:
+            os.kill(pid, signal.SIGKILL)
+        for pid in list(self.pids):
+            os.waitpid(pid, 0)
+        self.pids.clear()
+
+
+class SingletonLock:
+    """Exclusive flock on a file of directory, held until the process exits : the kernel
+    releases it then, whether the process stopped gracefully or crashed."""
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, SINGLETON_LOCK_FILE)
+        self.fd = None
+
+    async def acquire(self) -> None:
+        """Wait, without blocking the event loop, for the previous holder to exit"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                await asyncio.sleep(SINGLETON_POLL_S)
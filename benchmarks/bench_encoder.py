@@ -0,0 +1,85 @@
+"""Encoding cost of a DescribeTopicPartitions response with many partitions : the former
+{"value", "format"} dict pipeline against ResponseWriter.
+
+    python -m benchmarks.bench_encoder [partitions]
+"""
+import asyncio
+import sys
+import tempfile
+import time
+from struct import pack
+
+from app import main as broker
+from app.encoder import ResponseWriter
+from app.metadata import Partition, PartitionTable
+
+TOPIC_UUID = 0x1234
+
+
+class Request:
+    def __init__(self, body: bytes):
+        self.request_body = body
+        self.request_V2_header = {"request_api_version": 0}
+
+
+def legacy_encode(partitions: list) -> bytes:
+    """Dict building and field by field packing as done before ResponseWriter"""
+    _response = {}
+    for Partition_ID, Replica_Array_Length, Replica_Array in partitions:
+        prefix = f"topic_{TOPIC_UUID}_partition_{Partition_ID}"
+        _response[f"{prefix} Error Code"] = {"value": 0, "format": "H"}
+        _response[f"{prefix} Partition Index"] = {"value": Partition_ID, "format": "I"}
+        _response[f"{prefix} Leader ID"] = {"value": 0, "format": "I"}
+        _response[f"{prefix} Leader Epoch"] = {"value": 0, "format": "I"}
+        _response[f"{prefix} Replica Nodes Length"] = {"value": Replica_Array_Length, "format": "B"}
+        _response[f"{prefix} Replica Node_0"] = {"value": Replica_Array, "format": "I"}
+        _response[f"{prefix} ISR Nodes Array Length"] = {"value": 2, "format": "B"}
+        _response[f"{prefix} ISR Node_0"] = {"value": 1, "format": "I"}
+        _response[f"{prefix} Eligible Leader Replicas Array Length"] = {"value": 1, "format": "B"}
+        _response[f"{prefix} Last Known ELR Array Length"] = {"value": 1, "format": "B"}
+        _response[f"{prefix} Offline Replicas Array Length"] = {"value": 1, "format": "B"}
+        _response[f"{prefix}_tag_buffer"] = {"value": 0, "format": "B"}
+    data_to_send = b""
+    for value_format_pair in _response.values():
+        data_to_send += pack(">" + value_format_pair["format"], value_format_pair["value"])
+    return data_to_send
+
+
+def main(partitions: int = 5000, rounds: int = 5) -> None:
+    name = b"bench-topic"
+    table = [(i, 2, 1) for i in range(partitions)]
+    with tempfile.TemporaryDirectory() as logs:
+        # an empty metadata log whose indexes are filled in directly
+        broker.path_to_logs = logs + "/"
+        open(broker.path_to_logs + broker.log_file, "wb").close()
+        broker.metadata_store.refresh()
+        broker.metadata_store.topic_ids = {name: TOPIC_UUID}
+        broker.metadata_store.topic_names = {TOPIC_UUID: name}
+        broker.metadata_store.partitions = PartitionTable()
+        for partition_id, _replica_array_length, replica in table:
+            broker.metadata_store.partitions.set_partition(
+                Partition(0, partition_id, TOPIC_UUID, (replica,), (replica,), (), (), replica, 0, 0)
+            )
+        body = bytes([2, len(name) + 1]) + name + bytes([0]) + pack(">IBB", 100, 0xFF, 0)
+        request = Request(body)
+        broker.Utilities.display = staticmethod(lambda *args: None)
+
+        def writer_encode():
+            response = ResponseWriter()
+            asyncio.run(broker.DescribeTopicPartitions.prepare_response_body(request, response))
+            return response.finish()
+
+        for label, fn in (
+            ("dict pipeline (partitions only)", lambda: legacy_encode(table)),
+            ("ResponseWriter (whole response)", writer_encode),
+        ):
+            fn()
+            start = time.perf_counter()
+            for _ in range(rounds):
+                fn()
+            elapsed = (time.perf_counter() - start) / rounds
+            print(f"{label:<35} {partitions} partitions {elapsed * 1e3:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,158 @@
+"""Metadata load, topic lookup and Fetch encoding against synthetic clusters of 10, 10k and
+100k partitions (100 partitions per topic), written by benchmarks.kraft_gen.
+
+Metadata parsing is compared with the parsers MetadataLogParser replaced, frozen in
+benchmarks.legacy_metadata, and the replay of the whole log with the restore of a snapshot.
+
+Each case is timed like pytest-benchmark does : one warmup call, then rounds until both
+--min-rounds and --max-time are reached, reported as min / median / mean / max / stddev.
+Lookups are timed per batch of LOOKUPS calls. The memory of the PartitionTable of each
+cluster is reported with the timings.
+
+    python -m benchmarks.bench_metadata [--sizes 10,10000,100000] [--min-rounds 3] [--max-time 1.0]
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import statistics
+import struct
+import tempfile
+import time
+
+from app import main as broker
+from app import snapshot, storage
+from app.encoder import ResponseWriter
+from app.metadata import Metadata, MetadataLogParser
+
+from . import kraft_gen, legacy_metadata
+
+PARTITIONS_PER_TOPIC = 100
+LOOKUPS = 1000
+FETCH_PARTITION = struct.Struct(">iiqiqi")
+
+
+class Request:
+    def __init__(self, body: bytes):
+        self.request_body = body
+        self.request_V2_header = {"request_api_version": 16}
+
+
+def fetch_request_body(topic_id: bytes, partitions: int, partition_max_bytes: int = 1 << 20) -> bytes:
+    """Fetch v16 body of every partition of a topic, from offset 0, without session"""
+    body = struct.pack(">iiibii", 0, 1, 50 << 20, 0, 0, -1) + bytes([2]) + topic_id + bytes([partitions + 1])
+    for index in range(partitions):
+        body += FETCH_PARTITION.pack(index, -1, 0, -1, 0, partition_max_bytes) + b"\x00"
+    return body + b"\x00" + bytes([1, 1, 0])
+
+
+def bench(fn, min_rounds: int, max_time: float) -> list[float]:
+    fn()
+    timings = []
+    deadline = time.perf_counter() + max_time
+    while len(timings) < min_rounds or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, partitions: int, timings: list[float]) -> None:
+    ms = [t * 1e3 for t in timings]
+    stddev = statistics.stdev(ms) if len(ms) > 1 else 0.0
+    print(
+        f"{name:<38} {partitions:>7} {min(ms):10.3f} {statistics.median(ms):10.3f}"
+        f" {statistics.mean(ms):10.3f} {max(ms):10.3f} {stddev:9.3f} {len(ms):6}"
+    )
+
+
+def run(partitions: int, min_rounds: int, max_time: float) -> None:
+    topics = max(1, partitions // PARTITIONS_PER_TOPIC)
+    per_topic = min(partitions, PARTITIONS_PER_TOPIC)
+    with tempfile.TemporaryDirectory() as logs:
+        created = kraft_gen.write_cluster_metadata(logs, topics, per_topic)
+        # records for the fetched topic only : 5 batches of 10 records of 100 bytes per partition
+        kraft_gen.write_partition_logs(logs, [created[0][0]], per_topic, 5, 10, 100)
+        broker.logs_dir = logs + "/"
+        broker.path_to_logs = os.path.join(logs, "__cluster_metadata-0") + "/"
+        with open(broker.path_to_logs + broker.log_file, "rb") as f:
+            raw = f.read()
+
+        def parse():
+            with open(broker.path_to_logs + broker.log_file, "rb") as f:
+                for _ in MetadataLogParser(f.read()):
+                    pass
+
+        def parse_legacy_log():
+            legacy_metadata.MetaDataLog(broker.path_to_logs + broker.log_file)
+
+        def load_legacy_metadata():
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                legacy_metadata.Metadata(raw)
+
+        def load_metadata():
+            Metadata(raw)
+
+        def load_store():
+            broker.MetadataStore(broker.log_file).refresh()
+
+        report("parse MetadataLogParser", partitions, bench(parse, min_rounds, max_time))
+        report("parse legacy MetaDataLog", partitions, bench(parse_legacy_log, min_rounds, max_time))
+        report("load legacy Metadata", partitions, bench(load_legacy_metadata, min_rounds, max_time))
+        report("load Metadata", partitions, bench(load_metadata, min_rounds, max_time))
+        report("load MetadataStore", partitions, bench(load_store, min_rounds, max_time))
+
+        # the same load once a snapshot of the whole log has been written
+        taken = asyncio.run(broker.MetadataStore(broker.log_file).take_snapshot())
+        snapshot.write_snapshot(broker.path_to_logs, taken, snapshot.encode(taken))
+        report("load MetadataStore from snapshot", partitions, bench(load_store, min_rounds, max_time))
+
+        store = broker.metadata_store
+        store.clear()
+        store.refresh()
+        table = store.partitions
+        print(f"{'PartitionTable memory':<38} {partitions:>7} {table.nbytes() / 1e6:10.3f} MB, {table.nbytes() / max(len(table), 1):.0f} bytes per partition")
+        rng = random.Random(0)
+        names = [rng.choice(created)[0] for _ in range(LOOKUPS)]
+        ids = [store.find_topic(name) for name in names]
+
+        def find_topics():
+            for name in names:
+                store.find_topic(name)
+
+        def find_partitions():
+            for topic_id in ids:
+                store.find_partitions(topic_id)
+
+        report(f"find_topic x{LOOKUPS}", partitions, bench(find_topics, min_rounds, max_time))
+        report(f"find_partitions x{LOOKUPS}", partitions, bench(find_partitions, min_rounds, max_time))
+
+        request = Request(fetch_request_body(created[0][1].bytes, per_topic))
+        loop = asyncio.new_event_loop()
+
+        def encode_fetch():
+            response = ResponseWriter()
+            loop.run_until_complete(broker.Fetch.prepare_response_body(request, response))
+            response.finish()
+
+        report(f"Fetch encoding ({per_topic} partitions)", partitions, bench(encode_fetch, min_rounds, max_time))
+        loop.close()
+        for log in storage.partition_logs.values():
+            log.appender.close()
+        storage.partition_logs.clear()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,10000,100000", help="cluster sizes in partitions")
+    parser.add_argument("--min-rounds", type=int, default=3)
+    parser.add_argument("--max-time", type=float, default=1.0, help="seconds per case")
+    args = parser.parse_args()
+    print(f"{'case':<38} {'parts':>7} {'min ms':>10} {'median ms':>10} {'mean ms':>10} {'max ms':>10} {'stddev':>9} {'rounds':>6}")
+    for partitions in map(int, args.sizes.split(",")):
+        run(partitions, args.min_rounds, args.max_time)
+
+
+if __name__ == "__main__":
+    main()
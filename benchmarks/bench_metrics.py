@@ -0,0 +1,73 @@
+"""Cost of recording the request metrics, and accuracy of the histogram quantiles.
+
+A recorded request takes what AsyncBinaryServer does for it : the stats lookup, the
+counters and the total latency histogram, and the three stage histograms for one request
+in STAGE_SAMPLING, from the perf_counter_ns timestamps it takes.
+
+    python -m benchmarks.bench_metrics [requests]
+"""
+import random
+import sys
+import time
+
+from app.metrics import (
+    BYTES_IN,
+    REQUESTS,
+    STAGE_SAMPLING_MASK,
+    LatencyHistogram,
+    RequestMetrics,
+    record_handled,
+    record_sent,
+)
+
+
+def main(requests: int = 1_000_000) -> None:
+    rng = random.Random(0)
+    # log-normal latencies around 200 us, with a tail
+    latencies = [int(rng.lognormvariate(5.3, 0.8)) for _ in range(requests)]
+    # received, decode start, decoded, handled, sending, sent
+    timestamps = [
+        (0, 1000, 1000 + (latency << 4), (latency << 9) + 2000, (latency << 9) + 3000, latency * 1000 + 4000)
+        for latency in latencies
+    ]
+    metrics = RequestMetrics()
+    apis = metrics.apis
+
+    start = time.perf_counter()
+    for received, started, decoded, handled, sending, sent in timestamps:
+        stats = apis.get(1 << 16 | 16) or metrics.api(1, 16)
+        cells = stats.cells
+        sampled = not cells[REQUESTS] & STAGE_SAMPLING_MASK
+        cells[REQUESTS] += 1
+        cells[BYTES_IN] += 100
+        if sampled:
+            record_handled(cells, started, decoded, handled)
+            record_sent(cells, received, sending, sent, 1000)
+        else:
+            record_sent(cells, received, None, sent, 1000)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for received, started, decoded, handled, sending, sent in timestamps:
+        pass
+    overhead = time.perf_counter() - start
+    print(
+        f"{requests} requests recorded : {elapsed / requests * 1e9:.0f} ns per request,"
+        f" {(elapsed - overhead) / requests * 1e9:.0f} ns without the benchmark loop"
+    )
+
+    histogram = LatencyHistogram()
+    start = time.perf_counter()
+    for latency in latencies:
+        histogram.record(latency)
+    elapsed = time.perf_counter() - start
+    print(f"LatencyHistogram.record : {elapsed / requests * 1e9:.0f} ns per value")
+
+    ordered = sorted(latencies)
+    for q in (0.5, 0.99, 0.999):
+        exact = ordered[min(int(q * requests), requests - 1)]
+        estimate = histogram.quantile(q)
+        print(f"p{q * 100:g} : exact {exact} us, histogram {estimate} us ({(estimate - exact) / exact:+.1%})")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,86 @@
+"""ByteParser typed readers against the copying ByteParser they replaced, decoding the
+partitions of a Fetch request and a run of varints.
+
+    python -m benchmarks.bench_parser [partitions] [varints]
+"""
+import struct
+import sys
+import time
+
+from app.parser import ByteParser
+from app.varint import encode_varint
+
+from .legacy_metadata import LegacyByteParser
+
+FETCH_PARTITION = struct.Struct(">iiqiqi")
+
+
+def legacy_partitions(body: bytes, partitions: int) -> None:
+    parser = LegacyByteParser(body)
+    for _ in range(partitions):
+        int.from_bytes(parser.consume(4), byteorder="big", signed=True)
+        int.from_bytes(parser.consume(4), byteorder="big", signed=True)
+        int.from_bytes(parser.consume(8), byteorder="big", signed=True)
+        int.from_bytes(parser.consume(4), byteorder="big", signed=True)
+        int.from_bytes(parser.consume(8), byteorder="big", signed=True)
+        int.from_bytes(parser.consume(4), byteorder="big", signed=True)
+        parser.consume_var_int(False)  # tagged fields
+
+
+def typed_partitions(body: bytes, partitions: int) -> None:
+    parser = ByteParser(body)
+    for _ in range(partitions):
+        parser.int32()
+        parser.int32()
+        parser.int64()
+        parser.int32()
+        parser.int64()
+        parser.int32()
+        parser.skip_tagged_fields()
+
+
+def unpack_partitions(body: bytes, partitions: int) -> None:
+    parser = ByteParser(body)
+    for _ in range(partitions):
+        parser.unpack(FETCH_PARTITION)
+        parser.skip_tagged_fields()
+
+
+def legacy_varints(data: bytes, count: int) -> None:
+    parser = LegacyByteParser(data)
+    for _ in range(count):
+        parser.consume_var_int()
+
+
+def typed_varints(data: bytes, count: int) -> None:
+    parser = ByteParser(data)
+    for _ in range(count):
+        parser.varlong()
+
+
+def timed(fn, *args, rounds: int = 5) -> float:
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(*args)
+    return (time.perf_counter() - start) / rounds
+
+
+def main(partitions: int = 100_000, varints: int = 500_000) -> None:
+    body = b"".join(FETCH_PARTITION.pack(i, -1, i * 10, -1, 0, 1 << 20) + b"\x00" for i in range(partitions))
+    for label, fn in (
+        ("legacy consume + int.from_bytes", legacy_partitions),
+        ("ByteParser typed readers", typed_partitions),
+        ("ByteParser.unpack", unpack_partitions),
+    ):
+        elapsed = timed(fn, body, partitions)
+        print(f"{label:<32} {partitions} partitions {elapsed / partitions * 1e9:8.0f} ns per partition")
+
+    data = b"".join(encode_varint(i * 37 - varints) for i in range(varints))
+    for label, fn in (("legacy consume_var_int", legacy_varints), ("ByteParser.varlong", typed_varints)):
+        elapsed = timed(fn, data, varints)
+        print(f"{label:<32} {varints} varints {elapsed / varints * 1e9:8.0f} ns per varint")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
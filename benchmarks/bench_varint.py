@@ -0,0 +1,98 @@
+"""Microbenchmarks for app.varint against the previous binary-string decoders.
+
+The input mimics the varint headers of a metadata log : for every record, its length,
+timestamp delta, offset delta, key length and value length, followed by the headers count.
+
+    python -m benchmarks.bench_varint [records]
+"""
+import io
+import sys
+import time
+
+from app import varint
+
+FIELDS_PER_RECORD = 6
+
+
+def legacy_read_varint(f, signed=True):
+    """Decoder used by Utilities.read_varint / app.util before app.varint existed"""
+    val = ""
+    while True:
+        b = f.read(1)
+        num = bin(int.from_bytes(b))[2:].zfill(8)
+        val = num[1:] + val
+        if int.from_bytes(b) & 0x80 == 0:
+            break
+    n = int(val, 2)
+    return (n >> 1) - (n & 1) * n if signed else n
+
+
+def legacy_int_to_var_int(n):
+    binary_str = "{0:b}".format(n)
+    byte_reps = []
+    i = len(binary_str)
+    for i in range(len(binary_str) - 7, -1, -7):
+        arr = binary_str[i : i + 7]
+        if i != 0:
+            byte_reps.append("1" + arr)
+        else:
+            byte_reps.append("0" + arr)
+    if i != 0:
+        s = binary_str[:i]
+        byte_reps.append("0" * (8 - len(s)) + s)
+    return [int(b, 2) for b in byte_reps]
+
+
+def synthetic_headers(records: int) -> list[int]:
+    values = []
+    for i in range(records):
+        value_length = 24 + i % 200
+        values += [value_length + 8, 0, i % 1000, -1, value_length, 0]
+    return values
+
+
+def timed(label: str, count: int, fn, baseline: float | None = None) -> float:
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    speedup = f"x{baseline / elapsed:.1f}" if baseline else ""
+    print(f"{label:<42} {elapsed:8.3f} s {count / elapsed / 1e6:7.2f} M varints/s {speedup:>6}")
+    return elapsed
+
+
+def main(records: int = 1_000_000) -> None:
+    values = synthetic_headers(records)
+    count = len(values)
+    data = b"".join(varint.encode_varint(v) for v in values)
+    print(f"{records} records, {count} varints, {len(data)} bytes")
+
+    def legacy_file():
+        f = io.BytesIO(data)
+        for _ in range(count):
+            legacy_read_varint(f)
+
+    def new_file():
+        f = io.BytesIO(data)
+        for _ in range(count):
+            varint.read_varint(f)
+
+    def new_single():
+        view = memoryview(data)
+        offset = 0
+        for _ in range(count):
+            _value, offset = varint.decode_varint(view, offset)
+
+    def new_batch():
+        varint.decode_varints(data, 0, count)
+
+    legacy = timed("legacy read_varint (file, bin strings)", count, legacy_file)
+    timed("varint.read_varint (file)", count, new_file, legacy)
+    timed("varint.decode_varint (memoryview/offset)", count, new_single, legacy)
+    timed("varint.decode_varints (batch)", count, new_batch, legacy)
+
+    unsigned = list(map(varint.zigzag_encode, values))
+    legacy = timed("legacy int_to_var_int", count, lambda: [legacy_int_to_var_int(v) for v in unsigned])
+    timed("varint.encode_unsigned_varint", count, lambda: [varint.encode_unsigned_varint(v) for v in unsigned], legacy)
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,181 @@
+"""Synthetic KRaft logs : a __cluster_metadata log with N topics x M partitions, and data
+partition logs with record batches of a given shape, so that the broker can be run and
+benchmarked without a Kafka installation creating /tmp/kraft-combined-logs.
+
+The metadata log starts with a metadata.version FeatureLevelRecord, then has one batch per
+topic (its TopicRecord and PartitionRecords), as written by a controller creating topics.
+Topic ids are drawn from --seed, so that the same arguments give the same files.
+
+    python -m benchmarks.kraft_gen [--logs-dir DIR] [--topics N] [--partitions M]
+        [--batches B] [--records R] [--record-size S] [--data-topics T]
+"""
+import argparse
+import os
+import random
+import struct
+import time
+import uuid
+
+from app import main as broker
+from app import storage
+from app.varint import encode_unsigned_varint, encode_varint
+
+METADATA_VERSION = 20
+BROKER_ID = 1
+FEATURE_LEVEL_RECORD = 12
+TOPIC_RECORD = 2
+PARTITION_RECORD = 3
+SEGMENT = "00000000000000000000.log"
+
+
+def compact_string(value: bytes) -> bytes:
+    return encode_unsigned_varint(len(value) + 1) + value
+
+
+def compact_int32_array(values: list[int]) -> bytes:
+    return encode_unsigned_varint(len(values) + 1) + struct.pack(f">{len(values)}i", *values)
+
+
+def feature_level_record(name: bytes, level: int) -> bytes:
+    # frame version, type, version, name, feature level, tagged fields
+    return bytes([1, FEATURE_LEVEL_RECORD, 0]) + compact_string(name) + struct.pack(">h", level) + b"\x00"
+
+
+def topic_record(name: bytes, topic_id: uuid.UUID) -> bytes:
+    return bytes([1, TOPIC_RECORD, 0]) + compact_string(name) + topic_id.bytes + b"\x00"
+
+
+def partition_record(partition_id: int, topic_id: uuid.UUID, replicas: list[int], directory: uuid.UUID) -> bytes:
+    """PartitionRecord v1 : replicas all in sync, the first one leading"""
+    return (
+        bytes([1, PARTITION_RECORD, 1])
+        + struct.pack(">i", partition_id)
+        + topic_id.bytes
+        + compact_int32_array(replicas)  # replicas
+        + compact_int32_array(replicas)  # in sync replicas
+        + compact_int32_array([])  # removing replicas
+        + compact_int32_array([])  # adding replicas
+        + struct.pack(">iii", replicas[0], 0, 0)  # leader, leader epoch, partition epoch
+        + encode_unsigned_varint(len(replicas) + 1)
+        + directory.bytes * len(replicas)  # directories
+        + b"\x00"
+    )
+
+
+def record(offset_delta: int, value: bytes) -> bytes:
+    # attributes, timestamp delta, offset delta, null key, value, no headers
+    body = b"\x00" + encode_varint(0) + encode_varint(offset_delta) + encode_varint(-1)
+    body += encode_varint(len(value)) + value + encode_varint(0)
+    return encode_varint(len(body)) + body
+
+
+def record_batch(base_offset: int, values: list[bytes], timestamp_ms: int = 0) -> bytes:
+    """A v2 record batch holding one record per value"""
+    records = b"".join(record(offset_delta, value) for offset_delta, value in enumerate(values))
+    after_crc = struct.pack(
+        ">hiqqqhii", 0, len(values) - 1, timestamp_ms, timestamp_ms, -1, -1, -1, len(values)
+    ) + records
+    batch = struct.pack(">ibI", 0, storage.MAGIC_V2, storage.crc32c(after_crc)) + after_crc
+    return struct.pack(">qi", base_offset, len(batch)) + batch
+
+
+def topic_name(index: int) -> bytes:
+    return f"topic-{index:06d}".encode()
+
+
+def cluster_topics(topics: int, seed: int = 0) -> list[tuple[bytes, uuid.UUID]]:
+    """(name, topic id) of the generated topics"""
+    rng = random.Random(seed)
+    return [(topic_name(index), uuid.UUID(int=rng.getrandbits(128))) for index in range(topics)]
+
+
+def write_cluster_metadata(logs_dir: str, topics: int, partitions: int, replicas: int = 1, seed: int = 0) -> list[tuple[bytes, uuid.UUID]]:
+    """Write logs_dir/__cluster_metadata-0/ with topics x partitions partitions.
+
+    Returns:
+        list[tuple[bytes, uuid.UUID]]: (name, topic id) of the topics written
+    """
+    directory = os.path.join(logs_dir, "__cluster_metadata-0")
+    os.makedirs(directory, exist_ok=True)
+    now = int(time.time() * 1000)
+    log_directory = uuid.UUID(int=random.Random(seed).getrandbits(128) | 1)
+    replica_ids = list(range(BROKER_ID, BROKER_ID + replicas))
+    created = cluster_topics(topics, seed)
+    with open(os.path.join(directory, SEGMENT), "wb") as f:
+        f.write(record_batch(0, [feature_level_record(b"metadata.version", METADATA_VERSION)], now))
+        offset = 1
+        for name, topic_id in created:
+            values = [topic_record(name, topic_id)]
+            values += [partition_record(index, topic_id, replica_ids, log_directory) for index in range(partitions)]
+            f.write(record_batch(offset, values, now))
+            offset += len(values)
+    return created
+
+
+def write_partition_logs(logs_dir: str, topics: list[bytes], partitions: int, batches: int, records: int, record_size: int) -> None:
+    """Write one segment per partition of topics, of batches record batches of records records"""
+    value = b"x" * record_size
+    now = int(time.time() * 1000)
+    segment = b"".join(
+        record_batch(batch * records, [value] * records, now) for batch in range(batches)
+    )
+    for name in topics:
+        for index in range(partitions):
+            directory = os.path.join(logs_dir, f"{name.decode()}-{index}")
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, SEGMENT), "wb") as f:
+                f.write(segment)
+
+
+def generate(
+    logs_dir: str,
+    topics: int = 10,
+    partitions: int = 3,
+    replicas: int = 1,
+    seed: int = 0,
+    batches: int = 10,
+    records: int = 10,
+    record_size: int = 100,
+    data_topics: int = -1,
+) -> str:
+    """Write the metadata log and the data partition logs, returns a summary of what was written"""
+    created = write_cluster_metadata(logs_dir, topics, partitions, replicas, seed)
+    with_data = created if data_topics < 0 else created[:data_topics]
+    if batches > 0:
+        write_partition_logs(logs_dir, [name for name, _ in with_data], partitions, batches, records, record_size)
+    return (
+        f"{logs_dir} : {topics} topics x {partitions} partitions,"
+        f" {len(with_data) * partitions if batches > 0 else 0} data partitions"
+        f" of {batches} x {records} records of {record_size} bytes"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logs-dir", default=broker.logs_dir)
+    parser.add_argument("--topics", type=int, default=10)
+    parser.add_argument("--partitions", type=int, default=3, help="partitions per topic")
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batches", type=int, default=10, help="record batches per data partition")
+    parser.add_argument("--records", type=int, default=10, help="records per batch")
+    parser.add_argument("--record-size", type=int, default=100, help="bytes per record value")
+    parser.add_argument("--data-topics", type=int, default=-1, help="topics given data partition logs, -1 for all")
+    args = parser.parse_args()
+
+    print(
+        generate(
+            args.logs_dir,
+            args.topics,
+            args.partitions,
+            args.replicas,
+            args.seed,
+            args.batches,
+            args.records,
+            args.record_size,
+            args.data_topics,
+        )
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,631 @@
+"""Frozen copies of the metadata log parsers replaced by app.metadata.MetadataLogParser,
+kept as the baseline of benchmarks.bench_metadata : MetaDataLog (app/main.py) and Metadata
+with its ByteParser (app/metadata.py, app/parser.py), as of before the replacement.
+
+MetaDataLog takes the path of the log file instead of a name relative to path_to_logs.
+"""
+import json
+import uuid
+from collections import defaultdict
+from enum import Enum
+from typing import Any
+
+from app.varint import decode_unsigned_varlong, decode_varlong, read_unsigned_varint, read_varint
+
+DEBUG = False
+
+
+class MetadataLogFile(Enum):
+    BASE_OFFSET_SIZE = 8
+    BATCH_LENGTH_SIZE = 4
+    PARTITION_LEADER_EPOCH = 4
+    MAGIC_BYTE = 1
+    CRC = 4
+    ATTRIBUTES = 2
+    LAST_OFFSET_DELTA = 4
+    BASE_TIMESTAMP = 8
+    MAX_TIMESTAMP = 8
+    PRODUCER_ID = 8
+    PRODUCER_EPOCH = 2
+    BASE_SEQUENCE = 4
+    RECORDS_LENGTH = 4
+    # indivudual record constants :
+    R_LENGTH = 1  # VARINT
+    R_ATTRIBUTES = 1
+    R_TIMESTAMP_DELTA = 1
+    R_OFFSET_DELTA = 1
+    R_KEY_LENGTH = 1
+    R_VALUE_LENGTH = 1
+    # Value in record constants
+    R_V_FRAME_VERSION = 1
+    R_V_TYPE = 1
+    R_V_VERSION = 1
+    R_V_NAME_LENGTH = 1
+    R_V_FEATURE_LEVEL = 2
+    R_V_TAGGED_FIELDS_COUNTS = 1
+    R_V_TOPIC_UUID = 16
+    R_V_PARTITION_ID = 4
+    R_V_LENGTH_OF_REPLICA_ARRAY = 1
+    R_V_REPLICA_ARRAY = 4
+    R_HEADERS_ARRAY_COUNT = 1
+class MetaDataLog:
+    def __init__(self, file_name, position: int = 0):
+        """
+        Args:
+            file_name (str): metadata log file path
+            position (int, optional): file position of the first batch to parse. Defaults to 0.
+        """
+        self.file_name = file_name
+        self.log = {}
+        self.position = position  # end of the last fully parsed batch
+        self.last_offset = -1  # offset of the last record of the last fully parsed batch
+        self.parse_common_structure()
+    def parse_common_structure(self) -> None:
+        """
+        Parse self.file_name binary file from self.position and fill the self.log dictionnary with the info retrieved.
+        A partial batch at the end of the file is left untouched : self.position stops right before it.
+        """
+        batch_header_size = (
+            MetadataLogFile.BASE_OFFSET_SIZE.value
+            + MetadataLogFile.BATCH_LENGTH_SIZE.value
+        )
+        with open(self.file_name, "rb") as f:
+            if DEBUG:
+                print(f"----file {self.file_name} content : {f.read().hex(':')}---")
+            f.seek(0, 2)
+            file_size = f.tell()
+            f.seek(self.position)
+            if DEBUG:
+                print(f"File size : {file_size}")
+            Record_Batch = 1
+            while f.tell() + batch_header_size <= file_size:
+                if DEBUG:
+                    print(f"File position begining of new batch : {f.tell()}")
+                batch_start = f.tell()
+                batch_end = (
+                    batch_start
+                    + batch_header_size
+                    + int.from_bytes(f.read(batch_header_size)[-4:], byteorder="big")
+                )
+                if batch_end > file_size:
+                    # batch still being written, it will be parsed on the next call
+                    break
+                f.seek(batch_start)
+                self.log[f"Record Batch #{Record_Batch}"] = {}
+                self.log[f"Record Batch #{Record_Batch}"]["Base Offset"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.BASE_OFFSET_SIZE.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Batch Length"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.BATCH_LENGTH_SIZE.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Partition Leader Epoch"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.PARTITION_LEADER_EPOCH.value),
+                        byteorder="big",
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Magic Byte"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.MAGIC_BYTE.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["CRC"] = int.from_bytes(
+                    f.read(MetadataLogFile.CRC.value), byteorder="big", signed=True
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Attributes"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.ATTRIBUTES.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Last Offset Delta"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.LAST_OFFSET_DELTA.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Base Timestamp"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.BASE_TIMESTAMP.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Max Timestamp"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.MAX_TIMESTAMP.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Producer ID"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.PRODUCER_ID.value),
+                        byteorder="big",
+                        signed=True,
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Producer Epoch"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.PRODUCER_EPOCH.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Base Sequence"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.BASE_SEQUENCE.value), byteorder="big"
+                    )
+                )
+                self.log[f"Record Batch #{Record_Batch}"]["Records Length"] = (
+                    int.from_bytes(
+                        f.read(MetadataLogFile.RECORDS_LENGTH.value), byteorder="big"
+                    )
+                )
+                # Records parsing
+                for record in range(
+                    self.log[f"Record Batch #{Record_Batch}"]["Records Length"]
+                ):
+                    if DEBUG:
+                        print(
+                            f"File position begining of new record in batch : {f.tell()}"
+                        )
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"] = {}
+                    # next field is a varint ...
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Length"
+                    ] = read_varint(f)
+                    if DEBUG:
+                        print(
+                            f' self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Length"] {self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Length"]}'
+                        )
+                    pos = f.tell()
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Attributes"
+                    ] = int.from_bytes(
+                        f.read(MetadataLogFile.R_ATTRIBUTES.value), byteorder="big"
+                    )
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Timestamp Delta"
+                    ] = int.from_bytes(
+                        f.read(MetadataLogFile.R_TIMESTAMP_DELTA.value), byteorder="big"
+                    )
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Offset Delta"
+                    ] = int.from_bytes(
+                        f.read(MetadataLogFile.R_OFFSET_DELTA.value), byteorder="big"
+                    )
+                    # next field is a varint ...
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Key Length"
+                    ] = read_varint(f)
+                    if DEBUG:
+                        print(
+                            f'self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Key Length"] : {self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Key Length"]}'
+                        )
+                    if (
+                        self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                            "Key Length"
+                        ]
+                        != -1
+                    ):
+                        self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                            "Key"
+                        ] = 0  # not implemented
+                    else:
+                        self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                            "Key"
+                        ] = 0
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Value Length"
+                    ] = read_varint(f)
+                    # self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value Length"] = int.from_bytes(f.read(MetadataLogFile.R_VALUE_LENGTH.value), byteorder="big")
+                    if DEBUG:
+                        print(
+                            f'self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value Length"] : {self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value Length"]}'
+                        )
+                    # Value in record parsing
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Value"
+                    ] = {}
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Value"
+                    ]["Frame Version"] = int.from_bytes(
+                        f.read(MetadataLogFile.R_V_FRAME_VERSION.value), byteorder="big"
+                    )
+                    self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"][
+                        "Value"
+                    ]["Type"] = int.from_bytes(
+                        f.read(MetadataLogFile.R_V_TYPE.value), byteorder="big"
+                    )
+                    if DEBUG:
+                        print(
+                            f'self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value"]["Type"]  == {self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value"]["Type"]}'
+                        )
+                    match self.log[f"Record Batch #{Record_Batch}"][
+                        f"Record #{record}"
+                    ]["Value"]["Type"]:
+                        case 2:
+                            # Topic Record
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Version"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_VERSION.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Name_Length"] = read_unsigned_varint(f)
+                            if DEBUG:
+                                print(
+                                    f'self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value"]["Name_Length"] : {self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value"]["Name_Length"]}'
+                                )
+                            # self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value"]["Name_Length"] = int.from_bytes(f.read(MetadataLogFile.R_V_NAME_LENGTH.value), byteorder="big")
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Topic Name"] = int.from_bytes(
+                                f.read(
+                                    self.log[f"Record Batch #{Record_Batch}"][
+                                        f"Record #{record}"
+                                    ]["Value"]["Name_Length"]
+                                    - 1
+                                ),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Topic UUID"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_TOPIC_UUID.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Tagged Fields Counts"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_TAGGED_FIELDS_COUNTS.value),
+                                byteorder="big",
+                            )
+                            # TODO : implement tagged fields
+                        case 3:
+                            # Partition Record
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Version"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_VERSION.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Partition ID"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_PARTITION_ID.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Topic UUID"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_TOPIC_UUID.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Replica Array Length"] = int.from_bytes(
+                                f.read(
+                                    MetadataLogFile.R_V_LENGTH_OF_REPLICA_ARRAY.value
+                                ),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Replica Array"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_REPLICA_ARRAY.value),
+                                byteorder="big",
+                            )
+                        case 9:
+                            # Remove Topic Record
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Version"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_VERSION.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Topic UUID"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_TOPIC_UUID.value),
+                                byteorder="big",
+                            )
+                        case 12:
+                            # Feature Level Record
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Version"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_VERSION.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Name_Length"] = read_unsigned_varint(f)
+                            # self.log[f"Record Batch #{Record_Batch}"][f"Record #{record}"]["Value"]["Name_Length"] = int.from_bytes(f.read(MetadataLogFile.R_V_NAME_LENGTH.value), byteorder="big")
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Name"] = int.from_bytes(
+                                f.read(
+                                    self.log[f"Record Batch #{Record_Batch}"][
+                                        f"Record #{record}"
+                                    ]["Value"]["Name_Length"]
+                                    - 1
+                                ),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Feature Level"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_FEATURE_LEVEL.value),
+                                byteorder="big",
+                            )
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["Tagged Fields Counts"] = int.from_bytes(
+                                f.read(MetadataLogFile.R_V_TAGGED_FIELDS_COUNTS.value),
+                                byteorder="big",
+                            )
+                            # TODO : implement tagged fields
+                        case _:
+                            if DEBUG:
+                                print("UNSUPPORTED")
+                            # unsupported
+                            self.log[f"Record Batch #{Record_Batch}"][
+                                f"Record #{record}"
+                            ]["Value"]["unsupported"] = self.log[
+                                f"Record Batch #{Record_Batch}"
+                            ][
+                                f"Record #{record}"
+                            ][
+                                "Value"
+                            ][
+                                "Type"
+                            ]
+                            # rewind until "Attributes"
+                    f.seek(
+                        pos
+                        + self.log[f"Record Batch #{Record_Batch}"][
+                            f"Record #{record}"
+                        ]["Length"]
+                    )
+                f.seek(batch_end)
+                self.position = batch_end
+                self.last_offset = (
+                    self.log[f"Record Batch #{Record_Batch}"]["Base Offset"]
+                    + self.log[f"Record Batch #{Record_Batch}"]["Last Offset Delta"]
+                )
+                Record_Batch += 1
+    def __str__(self):
+        return f"""===============================  BEGINNING OF parsed Metadata log file   =====================================  
+        {json.dumps(self.log, indent=4)} \
+        ===============================  END OF parsed Metadata log file  ====================================="""
+    def find_partitions_details_for_topic(self, uuid_value: str) -> bool | list[Any]:
+        """MetaDatalog method for returning partition details from a topic uuid
+        Args:
+            uuid_value (str): topic uuid
+        Returns:
+            dict | bool : dictionnary with partition ID, Replicas, etc - very partially implemented OR False if no partition found
+        """
+        partitions_found = []
+        for record_batch, _content in self.log.items():
+            # Record Batch level
+            for i in range(self.log[record_batch]["Records Length"]):
+                if self.log[record_batch][f"Record #{i}"]["Value"]["Type"] == 3:
+                    if (
+                        self.log[record_batch][f"Record #{i}"]["Value"]["Topic UUID"]
+                        == uuid_value
+                    ):
+                        if DEBUG:
+                            print("++++++++++PARTION RECORD FOUND++++++++++")
+                        partitions_found.append(
+                            (
+                                self.log[record_batch][f"Record #{i}"]["Value"][
+                                    "Partition ID"
+                                ],
+                                self.log[record_batch][f"Record #{i}"]["Value"][
+                                    "Replica Array Length"
+                                ],
+                                self.log[record_batch][f"Record #{i}"]["Value"][
+                                    "Replica Array"
+                                ],
+                            )
+                        )
+        if not partitions_found:
+            if DEBUG:
+                print(f"+++++++++++++TOPIC UUID {uuid_value} NOT FOUND ")
+            return False
+        return partitions_found
+    def find_topic(self, topic_name: str) -> int | bool:
+        """MetaDatalog method for returning a Topic UUID if a topic name
+        Args:
+            topic_name (str)
+        Returns:
+            Topic UUID in int format or False if not found
+        """
+        if DEBUG:
+            print(f"SEARCHING {topic_name}")
+        for record_batch, _content in self.log.items():
+            # Record Batch level
+            for i in range(self.log[record_batch]["Records Length"]):
+                if self.log[record_batch][f"Record #{i}"]["Value"]["Type"] == 2:
+                    if (
+                        self.log[record_batch][f"Record #{i}"]["Value"]["Topic Name"]
+                        == topic_name
+                    ):
+                        if DEBUG:
+                            print("++++++++++TOPIC FOUND ++++++++++")
+                        return self.log[record_batch][f"Record #{i}"]["Value"][
+                            "Topic UUID"
+                        ]
+        if DEBUG:
+            print(f"+++++++++++++TOPIC {topic_name} NOT FOUND ")
+        return False
+
+
+class LegacyByteParser:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.index = 0  # Current position in the byte stream
+        self.finished = False
+
+    def eof(self):
+        return self.index == len(self.data)
+
+    def check_is_finished(self):
+        self.finished = self.index == len(self.data)
+
+    def read(self, num_bytes: int) -> bytes:
+        """Read num_bytes from the current position."""
+        if self.index + num_bytes > len(self.data):
+            raise ValueError("Not enough bytes to read")
+        result = self.data[self.index : self.index + num_bytes]
+        return result
+
+    def consume(self, num_bytes: int) -> bytes:
+        """Read num_bytes from the current position."""
+        if self.index + num_bytes > len(self.data):
+            raise ValueError("Not enough bytes to read")
+        result = self.data[self.index : self.index + num_bytes]
+        self.index += num_bytes
+        self.check_is_finished()
+        return result
+
+    def skip(self, num_bytes: int) -> None:
+        """Skip num_bytes in the stream by advancing the index."""
+        if self.index + num_bytes > len(self.data):
+            raise ValueError("Not enough bytes to skip")
+        self.index += num_bytes
+        self.check_is_finished()
+
+    def remaining(self) -> int:
+        """Return the number of remaining bytes."""
+        return len(self.data) - self.index
+
+    def reset(self) -> None:
+        """Reset the index to the start."""
+        self.index = 0
+        self.finished = False
+
+    def consume_var_int(self, signed=True):
+        if signed:
+            value, self.index = decode_varlong(self.data, self.index)
+        else:
+            value, self.index = decode_unsigned_varlong(self.data, self.index)
+        self.check_is_finished()
+        return value
+
+
+BASE_UUID = uuid.UUID("00000000-0000-0000-0000-000000000000")
+
+class Metadata:
+    def __init__(self, file):
+        self.parser = LegacyByteParser(file)
+        self.batches = 0
+        self.topics = defaultdict(lambda: {"uuid": BASE_UUID, "partitions": []})
+        self.partitions = {}
+        self.parse_log_file()
+        for id in self.partitions.keys():
+            topic_uuids = self.partitions[id]["topics"]
+            for uuid in topic_uuids:
+                for topic in self.topics:
+                    if uuid == self.topics[topic]["uuid"]:
+                        self.topics[topic]["partitions"].append(id)
+
+    def parse_log_file(self):
+        batches = self.separate_batches()
+        for batch in batches:
+            self.parse_batch(batch)
+
+    def separate_batches(self):
+        parser = self.parser
+        batches = []
+        while not parser.finished:
+            offset = parser.consume(8)
+            print(f"offset {int.from_bytes(offset)}")
+            self.batches += 1
+            batch_length = int.from_bytes(parser.consume(4))
+            batches.append(parser.consume(batch_length))
+        return batches
+
+    def parse_batch(self, batch):
+        parser = LegacyByteParser(batch)
+        ple = parser.consume(4)
+        mb = parser.consume(1)
+        crc = parser.consume(4)
+        type = parser.consume(2)
+        offset = parser.consume(4)
+        length = int.from_bytes(offset) + 1
+        created_at = parser.consume(8)
+        updated_at = parser.consume(8)
+        p_id = parser.consume(8)
+        p_epoch = parser.consume(2)
+        base_sequence = parser.consume(4)
+        record_count = parser.consume(4)
+        records = self.separate_records(parser)
+        for record in records:
+            self.parse_record(record)
+
+    def separate_records(self, parser):
+        records = []
+        while not parser.eof():
+            length = parser.consume_var_int()
+            record = parser.consume(length)
+            records.append(record)
+        return records
+
+    def parse_record(self, batch):
+        parser = LegacyByteParser(batch)
+        attribute = parser.consume(1)
+        timestamp_delta = parser.consume_var_int()
+        offset_delta = parser.consume_var_int()
+        key_length = parser.consume_var_int()
+        if key_length != -1:
+            parser.read(1)
+        value_length = parser.consume_var_int()
+        value = parser.consume(value_length)
+        self.parse_value(value)
+
+    def parse_value(self, value):
+        parser = LegacyByteParser(value)
+        frame_version = parser.consume(1)
+        type = int.from_bytes(parser.consume(1))
+        match type:
+            case 2:
+                self.parse_topic(parser)
+            case 3:
+                self.parse_partition(parser)
+
+    def parse_topic(self, parser):
+        version = parser.consume(1)
+        length_of_name = parser.consume_var_int(False) - 1
+        topic_name = parser.consume(length_of_name)
+        raw_uuid = parser.consume(16)
+        self.topics[topic_name] = {"uuid": uuid.UUID(bytes=raw_uuid), "partitions": []}
+
+    def parse_partition(self, parser):
+        version = parser.consume(1)
+        partition_id = parser.consume(4)
+        raw_uuid = parser.consume(16)
+        length_of_replica_array = parser.consume_var_int(False) - 1
+        replicas = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
+        in_sync = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
+        removing = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
+        adding = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
+        leader = parser.consume(4)
+        epoch = parser.consume(4)
+        partition_epoch = parser.consume(4)
+        directories = self.digest_array(parser, parser.consume_var_int(False) - 1, 4)
+        if partition_id in self.partitions:
+            self.partitions[partition_id]["topics"].append(uuid.UUID(bytes=raw_uuid))
+        else:
+            self.partitions[partition_id] = {
+                "topics": [uuid.UUID(bytes=raw_uuid)],
+                "id": partition_id,
+                "leader": leader,
+                "leader_epoch": epoch,
+            }
+
+    def digest_array(self, parser, length, size_per_item):
+        ret = []
+        for _ in range(length):
+            ret.append(parser.consume(size_per_item))
+        return ret
@@ -0,0 +1,307 @@
+"""End-to-end load generator speaking the Kafka wire protocol to a running broker.
+
+Each connection keeps up to --depth requests in flight (pipelining), drawn from a weighted
+mix of ApiVersions, DescribeTopicPartitions and Fetch requests over the topics of the
+cluster metadata. Latency is measured from the request write to the response read, in
+microseconds, with the broker's LatencyHistogram. The report is one JSON document, with
+the commit and the settings, so that runs can be compared across commits :
+
+    python -m benchmarks.loadgen --spawn --connections 32 --depth 8 --duration 10 > run.json
+
+--spawn starts python -m app.main for the run (and stops it afterwards), otherwise the
+broker must already listen on --host/--port. The request mix is deterministic (--seed).
+
+--logs-dir DIR generates the kraft_gen dataset with its default shape in DIR before the
+run, DIR emptied first, so that every run reads the same topics and records ; the broker
+serves DIR (given --logs-dir DIR when it is not spawned). Without it the run uses whatever
+the broker logs directory holds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from app import main as broker
+from app.metrics import LatencyHistogram
+from benchmarks import kraft_gen
+
+CLIENT_ID = b"loadgen"
+REQUEST_HEADER = struct.Struct(">ihhih")  # message size, api key, api version, correlation id, client id length
+FETCH_HEADER = struct.Struct(">iiibii")  # max wait, min bytes, max bytes, isolation level, session id, epoch
+FETCH_PARTITION = struct.Struct(">iiqiqi")  # index, current leader epoch, fetch offset, last fetched epoch, log start offset, max bytes
+API_KEYS = {"apiversions": (18, 4), "describe": (75, 0), "fetch": (1, 16)}
+DATASET_MARKER = ".loadgen-dataset"  # marks a directory generated by --logs-dir, that may be emptied
+
+
+def unsigned_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def request(api: str, body: bytes) -> bytes:
+    """Frame with a request header v2 and a correlation id of 0, patched when sent"""
+    api_key, api_version = API_KEYS[api]
+    header = REQUEST_HEADER.pack(
+        REQUEST_HEADER.size - 4 + len(CLIENT_ID) + 1 + len(body), api_key, api_version, 0, len(CLIENT_ID)
+    )
+    return header + CLIENT_ID + b"\x00" + body
+
+
+def apiversions_request() -> bytes:
+    software = b"loadgen"
+    return request(
+        "apiversions", unsigned_varint(len(software) + 1) + software + unsigned_varint(2) + b"1" + b"\x00"
+    )
+
+
+def describe_request(names: list[bytes]) -> bytes:
+    body = unsigned_varint(len(names) + 1)
+    for name in names:
+        body += unsigned_varint(len(name) + 1) + name + b"\x00"
+    return request("describe", body + struct.pack(">i", 100) + b"\xff\x00")
+
+
+def fetch_request(topics: list[tuple[bytes, list[int]]], max_bytes: int) -> bytes:
+    body = FETCH_HEADER.pack(0, 1, max_bytes, 0, 0, -1) + unsigned_varint(len(topics) + 1)
+    for topic_id, partitions in topics:
+        body += topic_id + unsigned_varint(len(partitions) + 1)
+        for index in partitions:
+            body += FETCH_PARTITION.pack(index, -1, 0, -1, 0, max_bytes) + b"\x00"
+        body += b"\x00"
+    return request("fetch", body + unsigned_varint(1) + unsigned_varint(1) + b"\x00")
+
+
+def request_pool(mix: dict[str, int], topics: dict[bytes, tuple[bytes, list[int]]], seed: int, size: int = 1024) -> list:
+    """Pre-built (api, frame) requests in a fixed random order, so that the generator only
+    patches correlation ids while running"""
+    rng = random.Random(seed)
+    names = sorted(topics)
+    pool = []
+    apis = [api for api, weight in mix.items() for _ in range(weight)]
+    for _ in range(size):
+        api = rng.choice(apis)
+        if api == "apiversions" or not names:
+            pool.append(("apiversions", apiversions_request()))
+        elif api == "describe":
+            pool.append((api, describe_request([rng.choice(names)])))
+        else:
+            topic_id, partitions = topics[rng.choice(names)]
+            pool.append((api, fetch_request([(topic_id, partitions or [0])], 1 << 20)))
+    return pool
+
+
+class Results:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.per_api = {api: LatencyHistogram() for api in API_KEYS}
+        self.requests = 0
+        self.bytes_in = 0  # response bytes received
+        self.bytes_out = 0
+        self.errors = 0  # connections that failed
+
+    def report(self, elapsed: float) -> dict:
+        def quantiles(histogram: LatencyHistogram) -> dict:
+            return {
+                "p50": histogram.quantile(0.5),
+                "p99": histogram.quantile(0.99),
+                "p999": histogram.quantile(0.999),
+                "max": histogram.max,
+            }
+
+        return {
+            "requests": self.requests,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(self.requests / elapsed, 1),
+            "response_mb_per_s": round(self.bytes_in / elapsed / 1e6, 3),
+            "request_mb_per_s": round(self.bytes_out / elapsed / 1e6, 3),
+            "latency_us": quantiles(self.latency),
+            "per_api": {
+                api: {"requests": histogram.count, "latency_us": quantiles(histogram)}
+                for api, histogram in self.per_api.items()
+                if histogram.count
+            },
+            "connection_errors": self.errors,
+        }
+
+
+async def connection(host: str, port: int, depth: int, pool: list, offset: int, deadline: float, record_after: float, results: Results) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    slots = asyncio.Semaphore(depth)
+    sent = []  # (api, send time ns) in correlation id order
+    sending = True
+
+    async def send() -> None:
+        nonlocal sending
+        correlation_id = 0
+        while time.monotonic() < deadline:
+            await slots.acquire()
+            api, frame = pool[(offset + correlation_id) % len(pool)]
+            frame = bytearray(frame)
+            struct.pack_into(">i", frame, 8, correlation_id)
+            sent.append((api, time.perf_counter_ns()))
+            writer.write(frame)
+            if time.monotonic() >= record_after:
+                results.bytes_out += len(frame)
+            correlation_id += 1
+            await writer.drain()
+        sending = False
+
+    sender = asyncio.create_task(send())
+    try:
+        received = 0
+        while sending or received < len(sent):
+            size = struct.unpack(">i", await reader.readexactly(4))[0]
+            await reader.readexactly(size)
+            now = time.perf_counter_ns()
+            api, started = sent[received]
+            received += 1
+            slots.release()
+            if time.monotonic() >= record_after:
+                latency = (now - started) // 1000
+                results.latency.record(latency)
+                results.per_api[api].record(latency)
+                results.requests += 1
+                results.bytes_in += 4 + size
+    except (ConnectionError, asyncio.IncompleteReadError):
+        results.errors += 1
+    finally:
+        sender.cancel()
+        writer.close()
+
+
+def wait_for_port(host: str, port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_dataset(logs_dir: str) -> str:
+    """Replace the content of logs_dir with the kraft_gen dataset. A directory not generated
+    by a previous run is only used when it is empty, instead of being deleted"""
+    if os.path.isdir(logs_dir) and os.listdir(logs_dir):
+        if not os.path.exists(os.path.join(logs_dir, DATASET_MARKER)):
+            raise ValueError(f"{logs_dir} is not empty and was not generated by loadgen")
+        shutil.rmtree(logs_dir)
+    summary = kraft_gen.generate(logs_dir)
+    open(os.path.join(logs_dir, DATASET_MARKER), "w").close()
+    return summary
+
+
+def cluster_topics() -> dict[bytes, tuple[bytes, list[int]]]:
+    """Topic name -> (topic id, partition indexes), read from the cluster metadata log"""
+    store = broker.metadata_store
+    store.refresh()
+    return {
+        name: (topic_id.to_bytes(16, "big"), sorted(partition[0] for partition in store.find_partitions(topic_id)))
+        for name, topic_id in store.topic_ids.items()
+    }
+
+
+async def run(args: argparse.Namespace, topics: dict) -> dict:
+    mix = {api: int(weight) for api, weight in (item.split("=") for item in args.mix.split(","))}
+    pool = request_pool(mix, topics, args.seed)
+    results = Results()
+    start = time.monotonic()
+    record_after = start + args.warmup
+    deadline = record_after + args.duration
+    await asyncio.gather(
+        *(
+            connection(args.host, args.port, args.depth, pool, i * 97, deadline, record_after, results)
+            for i in range(args.connections)
+        )
+    )
+    return results.report(time.monotonic() - record_after)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=broker.port)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--depth", type=int, default=4, help="requests in flight per connection")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds run before measuring")
+    parser.add_argument("--mix", default="apiversions=1,describe=1,fetch=1", help="weights of the request types")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spawn", action="store_true", help="run python -m app.main for the duration of the benchmark")
+    parser.add_argument("--workers", type=int, default=1, help="--workers of the spawned broker")
+    parser.add_argument("--logs-dir", help="generate the fixed kraft_gen dataset in this directory and serve it")
+    args = parser.parse_args()
+
+    dataset = None
+    if args.logs_dir is not None:
+        try:
+            dataset = generate_dataset(args.logs_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        broker.logs_dir = os.path.join(args.logs_dir, "")
+        broker.path_to_logs = broker.logs_dir + "__cluster_metadata-0/"
+    topics = cluster_topics()
+    server = None
+    if args.spawn:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "app.main", "--workers", str(args.workers), "--logs-dir", broker.logs_dir],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        wait_for_port(args.host, args.port, 30)
+    try:
+        report = asyncio.run(run(args, topics))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print(
+        json.dumps(
+            {
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "settings": {
+                    "connections": args.connections,
+                    "depth": args.depth,
+                    "duration_s": args.duration,
+                    "warmup_s": args.warmup,
+                    "mix": args.mix,
+                    "seed": args.seed,
+                    "workers": args.workers if args.spawn else None,
+                    "topics": len(topics),
+                    "dataset": dataset,
+                },
+                **report,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""PartitionTable against a dict model of the partitions : (topic id, partition id) -> fields."""
+import random
+import unittest
+
+from app.metadata import Partition, PartitionTable
+from app.snapshot import MetadataSnapshot, decode, encode
+
+
+def partition(topic_id: int, partition_id: int, replicas: tuple = (1,), isr: tuple | None = None, epoch: int = 0) -> Partition:
+    isr = replicas if isr is None else isr
+    return Partition(0, partition_id, topic_id, replicas, isr, (), (), replicas[0] if replicas else -1, epoch, epoch)
+
+
+def fields(record: Partition) -> tuple:
+    return (record.leader, record.leader_epoch, record.partition_epoch, tuple(record.replicas), tuple(record.isr))
+
+
+def row_fields(table: PartitionTable, row: int) -> tuple:
+    replicas_start, isr_start = table.replicas_start[row], table.isr_start[row]
+    return (
+        table.leader[row],
+        table.leader_epoch[row],
+        table.partition_epoch[row],
+        tuple(table.replicas[replicas_start : replicas_start + table.replicas_count[row]]),
+        tuple(table.isr[isr_start : isr_start + table.isr_count[row]]),
+    )
+
+
+class PartitionTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = PartitionTable()
+        self.model = {}
+
+    def set_partition(self, record: Partition) -> None:
+        self.table.set_partition(record)
+        self.model[record.topic_id, record.partition_id] = fields(record)
+
+    def remove_topic(self, topic_id: int) -> None:
+        self.table.remove_topic(topic_id)
+        self.model = {key: value for key, value in self.model.items() if key[0] != topic_id}
+
+    def assert_matches(self, table: PartitionTable | None = None) -> None:
+        table = self.table if table is None else table
+        self.assertEqual(len(table), len(self.model))
+        for (topic_id, partition_id), expected in self.model.items():
+            row = table.find(topic_id, partition_id)
+            self.assertIsNotNone(row, (topic_id, partition_id))
+            self.assertEqual(row_fields(table, row), expected)
+        for topic_id in {topic_id for topic_id, _ in self.model}:
+            rows = table.topic_rows(topic_id)
+            self.assertEqual(
+                sorted(table.partition_id[row] for row in rows),
+                sorted(partition_id for key_topic, partition_id in self.model if key_topic == topic_id),
+            )
+
+    def test_add_and_lookup(self):
+        for partition_id in range(4):
+            self.set_partition(partition(1, partition_id, (1, 2, 3)))
+        for partition_id in (2, 0, 1):
+            self.set_partition(partition(2, partition_id, (2,)))
+        # a partition added later to the first topic is appended out of its range
+        self.set_partition(partition(1, 4, (3, 1)))
+        self.assert_matches()
+        self.assertIsNone(self.table.find(1, 5))
+        self.assertIsNone(self.table.find(3, 0))
+        self.assertEqual(len(self.table.topic_rows(3)), 0)
+
+    def test_update(self):
+        self.set_partition(partition(1, 0, (1, 2, 3)))
+        self.set_partition(partition(1, 1, (1, 2, 3)))
+        self.set_partition(partition(1, 0, (3, 2, 1), epoch=1))  # same replica count, in place
+        self.set_partition(partition(1, 1, (1,), (1,), epoch=2))  # fewer replicas, moved
+        self.assert_matches()
+
+    def test_remove(self):
+        for topic_id in (1, 2, 3):
+            for partition_id in range(3):
+                self.set_partition(partition(topic_id, partition_id, (topic_id,)))
+        self.remove_topic(2)
+        self.assert_matches()
+        self.assertIsNone(self.table.find(2, 0))
+        self.remove_topic(2)  # unknown topic : nothing to do
+        self.set_partition(partition(2, 0, (4,)))  # recreated
+        self.assert_matches()
+
+    def test_compact(self):
+        for topic_id in (1, 2, 3):
+            for partition_id in range(3):
+                self.set_partition(partition(topic_id, partition_id, (1, 2)))
+        self.set_partition(partition(1, 3, (1, 2)))
+        self.set_partition(partition(3, 0, (1, 2, 3)))
+        self.remove_topic(2)
+        self.table.compact()
+        self.assertEqual(self.table.overflow, {})
+        self.assertEqual(self.table.dead_rows, 0)
+        self.assertEqual(self.table.dead_entries, 0)
+        self.assertEqual(len(self.table.replicas), sum(len(value[3]) for value in self.model.values()))
+        self.assertEqual(list(self.table.topic_ids), [1, 3])
+        self.assert_matches()
+
+    def test_random_operations(self):
+        rng = random.Random(0)
+        for step in range(2000):
+            topic_id = rng.randrange(1, 20)
+            if rng.random() < 0.03:
+                self.remove_topic(topic_id)
+            else:
+                replicas = tuple(rng.sample(range(1, 6), rng.randint(1, 3)))
+                isr = replicas[: rng.randint(0, len(replicas))]
+                self.set_partition(partition(topic_id, rng.randrange(8), replicas, isr, epoch=step))
+            if rng.random() < 0.05:
+                self.table.compact()
+            if step % 100 == 0:
+                self.assert_matches()
+        self.assert_matches()
+
+    def test_snapshot_round_trip(self):
+        rng = random.Random(1)
+        for topic_id in range(1, 30):
+            for partition_id in rng.sample(range(10), rng.randint(1, 10)):
+                self.set_partition(partition(topic_id << 64, partition_id, tuple(rng.sample(range(1, 6), 3))))
+        self.remove_topic(5 << 64)
+        topic_names = {topic_id << 64: f"topic-{topic_id}".encode() for topic_id in range(1, 30) if topic_id != 5}
+        snapshot = decode(encode(MetadataSnapshot(42, 1000, 900, topic_names, self.table)))
+        self.assertEqual((snapshot.last_offset, snapshot.position, snapshot.last_batch_position), (42, 1000, 900))
+        self.assertEqual(snapshot.topic_names, topic_names)
+        self.assert_matches(snapshot.partitions)
+
+    def test_copy_is_independent(self):
+        for partition_id in range(3):
+            self.set_partition(partition(1, partition_id, (1, 2)))
+        copy = self.table.copy()
+        expected = dict(self.model)
+        self.set_partition(partition(1, 0, (3, 4), epoch=5))
+        self.set_partition(partition(2, 0, (1,)))
+        self.remove_topic(1)
+        self.model, current = expected, self.model
+        self.assert_matches(copy)
+        self.model = current
+        self.assert_matches()
+
+
+if __name__ == "__main__":
+    unittest.main()